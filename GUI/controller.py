@@ -55,6 +55,10 @@ class Controller:
     def __init_model__(self):
         self._model = Model()
 
+        # Carica e scalda il detector in background,
+        # cosi' la prima immagine non paga il caricamento dei pesi.
+        Thread(target=self._model.warm_up, daemon=True).start()
+
 
     def __init_main_window__(self):
         """ Inizializza la finestra root. """
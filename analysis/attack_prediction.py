@@ -1,31 +1,41 @@
-import os
 import cv2
 import numpy as np
 
-def predictTeamAttacking(players_classification, img):
+from sportsfield_release.utils import profiling
+
+@profiling.timed('attack_scoring')
+def predictTeamAttacking(players_classification, img, sink=None):
+    """
+    Calcola le percentuali di attacco delle due squadre.
+    Se viene passato un sink abilitato, salva anche l'immagine con i poligoni
+    formati dai giocatori ('PolygonsPlayerPoints.png').
+    """
+    draw_polygons = sink is not None and sink.enabled
 
     def getAreas(coordinates_team_1, coordinates_team_2):
         """
         Calcola l'area formata dai giocatori più esterni di tutte le due squadre.
         """
-        height, width, channels = img.shape
-        img_empty = np.zeros((height, width, channels), dtype=np.uint8)
-
-        # Disegno i punti in una immagine vuota
-        for center in coordinates_team_1:
-            cv2.circle(img_empty, center, 5, (0, 0, 255), -1)
-        for center in coordinates_team_2:
-            cv2.circle(img_empty, center, 5, (255, 0, 0), -1)
-        for center in coordinates_goalkeeper:
-            cv2.circle(img_empty, center, 5, (0,255,0), -1)
-        
         # calcolo il convex hull per i punti delle due squadre per trovare i giocatori più esterni
         hull_points_team_1 = cv2.convexHull(coordinates_team_1)
         hull_points_team_2 = cv2.convexHull(coordinates_team_2)
 
-        # disegno le linee sull'immagine vuota per rappresentare l'area dei giocatori
-        cv2.polylines(img_empty, [hull_points_team_1], isClosed=True, color=(0,0,255), thickness=1)
-        cv2.polylines(img_empty, [hull_points_team_2], isClosed=True, color=(255,0,0), thickness=1)
+        if draw_polygons:
+            height, width, channels = img.shape
+            img_empty = np.zeros((height, width, channels), dtype=np.uint8)
+
+            # Disegno i punti in una immagine vuota
+            for center in coordinates_team_1:
+                cv2.circle(img_empty, center, 5, (0, 0, 255), -1)
+            for center in coordinates_team_2:
+                cv2.circle(img_empty, center, 5, (255, 0, 0), -1)
+            for center in coordinates_goalkeeper:
+                cv2.circle(img_empty, center, 5, (0,255,0), -1)
+
+            # disegno le linee sull'immagine vuota per rappresentare l'area dei giocatori
+            cv2.polylines(img_empty, [hull_points_team_1], isClosed=True, color=(0,0,255), thickness=1)
+            cv2.polylines(img_empty, [hull_points_team_2], isClosed=True, color=(255,0,0), thickness=1)
+            sink.write("PolygonsPlayerPoints.png", img_empty)
 
         def calculate_area(points):
             n = len(points)
@@ -36,10 +46,6 @@ def predictTeamAttacking(players_classification, img):
                 area -= points[j][0] * points[i][1]
             area = abs(area) / 2.0
             return area
-        
-        if not os.path.exists("results"):
-            os.makedirs("results")
-        cv2.imwrite(os.path.join("results", "PolygonsPlayerPoints.png"), img_empty)
 
         area_points_team_1 = calculate_area(hull_points_team_1.squeeze())
         area_points_team_2 = calculate_area(hull_points_team_2.squeeze())
@@ -220,3 +226,18 @@ def predictTeamAttacking(players_classification, img):
     percent_team_1, percent_team_2 = getPercentages(area_points_team_1, area_points_team_2, n_players_team_1, n_players_team_2, max_players_near_goalkeeper, counter_team_1, counter_team_2, team_closer_to_ball)
 
     return percent_team_1, percent_team_2
+
+
+def assignTeamNames(players_classification, percent_team_1, percent_team_2):
+    """
+    Rinomina le squadre 0/1 in 'Team A' / 'Team B' in base alle percentuali
+    di attacco: 'Team A' e' sempre la squadra con la percentuale piu' alta.
+    Ritorna il nome della squadra in attacco.
+    """
+    if percent_team_1 > percent_team_2:
+        players_classification['Team A'] = players_classification.pop(0)
+        players_classification['Team B'] = players_classification.pop(1)
+    else:
+        players_classification['Team B'] = players_classification.pop(0)
+        players_classification['Team A'] = players_classification.pop(1)
+    return 'Team A'
@@ -0,0 +1,135 @@
+"""
+Benchmark del profilo di esecuzione CPU (`util.apply_cpu_profile`).
+
+Per ogni configurazione (thread, channels_last, autocast bf16) ricrea le reti
+e misura i passi che contano nell'ottimizzazione:
+    - init_guess: forward dell'InitialGuesser (senza gradiente);
+    - loss_surface: un'iterazione dell'ottimizzazione DirectH, come in
+      `first_order_main_optimization_loop`: corner -> omografia -> warp del
+      template -> LossSurfaceRegressor, forward + backward fino ai corner;
+    - warp: `warp.warp_image` del template (solo forward).
+L'accuratezza e' confrontata con la configurazione di riferimento (fp32,
+layout contiguo): errore sull'IoU predetta, errore relativo sul gradiente
+rispetto ai corner e sui corner dell'init guess.
+
+Uso:
+    python -m benchmarks.bench_cpu_profile --threads 1 4 8 --repeats 10
+    python -m benchmarks.bench_cpu_profile --freeze --out-dir sportsfield_release/out
+"""
+import argparse
+import time
+import warnings
+
+import torch
+
+from offside.homography_calculator import buildOptions, prepareGoalImage, prepareTemplateImage
+from pipeline.frame import Frame
+from sportsfield_release.models import end_2_end_optimization_helper, inference_freeze, init_guesser, loss_surface
+from sportsfield_release.utils import util, warp
+
+
+def build_models(opt, freeze: bool):
+    """Reti create dopo aver applicato il profilo (il layout dei pesi dipende dal profilo)."""
+    upstream = util.set_model_device(init_guesser.InitialGuesserFactory.get_initial_guesser(opt)).eval()
+    error_model = util.set_model_device(loss_surface.ErrorModelFactory.get_error_model(opt)).eval()
+    if freeze:
+        inference_freeze.freeze(upstream)
+        inference_freeze.freeze(error_model)
+    return upstream, error_model
+
+
+def measure(fn, repeats: int) -> float:
+    """Tempo medio per chiamata in millisecondi (dopo una chiamata di riscaldamento)."""
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats * 1e3
+
+
+def corners_to_homography(corners):
+    return end_2_end_optimization_helper.get_homography_between_corners_and_default_canon4pts(corners, 'lower')
+
+
+def run_config(opt, frame, template, corners, freeze: bool, repeats: int) -> dict:
+    upstream, error_model = build_models(opt, freeze)
+    with torch.no_grad():
+        homography = corners_to_homography(corners)
+
+    def init_guess():
+        with torch.no_grad():
+            return upstream(frame)
+
+    def optim_iteration():
+        # stesso grafo dell'ottimizzazione: il gradiente arriva ai corner attraverso il warp
+        corners_optim = corners.clone().requires_grad_(True)
+        warped = warp.warp_image(template, corners_to_homography(corners_optim), out_shape=frame.shape[-2:])
+        score = error_model((frame, warped))
+        grad, = torch.autograd.grad(score.sum(), corners_optim)
+        return score.detach(), grad
+
+    def warp_template():
+        with torch.no_grad():
+            return warp.warp_image(template, homography, out_shape=frame.shape[-2:])
+
+    score, grad = optim_iteration()
+    return {
+        'init_guess_ms': measure(init_guess, repeats),
+        'loss_surface_ms': measure(optim_iteration, repeats),
+        'warp_ms': measure(warp_template, repeats),
+        'corners': init_guess(),
+        'score': score,
+        'grad': grad,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Effetto del profilo CPU su velocita\' e accuratezza.')
+    parser.add_argument('--image', default='data/test5.png', help='frame di prova')
+    parser.add_argument('--out-dir', default='sportsfield_release/out', help='cartella dei pesi pre-addestrati')
+    parser.add_argument('--threads', type=int, nargs='+', default=None,
+                        help='numeri di thread da provare (default: solo quello attuale)')
+    parser.add_argument('--freeze', action='store_true', help='reti congelate come in inferenza')
+    parser.add_argument('--repeats', type=int, default=10, help='chiamate misurate per configurazione')
+    args = parser.parse_args()
+
+    warnings.filterwarnings('ignore', category=UserWarning)
+    util.fix_randomness()
+    opt = buildOptions()
+    opt.out_dir = args.out_dir
+
+    frame = prepareGoalImage(Frame.from_path(args.image), opt)[None]
+    template = prepareTemplateImage(opt)[None]
+    # Corner di partenza: quelli dell'init guess pre-addestrato (fp32, layout contiguo)
+    util.apply_cpu_profile(channels_last=False, bf16_autocast=False)
+    upstream, _ = build_models(opt, freeze=False)
+    with torch.no_grad():
+        corners = upstream(frame).reshape(-1, 2, 4).permute(0, 2, 1).contiguous()
+
+    configs = [(f'threads={threads}', dict(threads=threads)) for threads in args.threads or []]
+    configs += [
+        ('channels_last', dict(channels_last=True)),
+        ('bf16', dict(bf16_autocast=True)),
+        ('channels_last+bf16', dict(channels_last=True, bf16_autocast=True)),
+    ]
+    default_threads = torch.get_num_threads()
+    reference = run_config(opt, frame, template, corners, args.freeze, args.repeats)
+
+    print(f"{'profilo':>20} {'init ms':>9} {'loss ms':>9} {'warp ms':>9} {'d IoU':>9} {'d grad':>9} {'d corner':>9}")
+
+    def report(name, result):
+        d_score = (result['score'] - reference['score']).abs().max().item()
+        d_grad = ((result['grad'] - reference['grad']).norm() / reference['grad'].norm().clamp_min(1e-12)).item()
+        d_corners = (result['corners'] - reference['corners']).abs().max().item()
+        print(f"{name:>20} {result['init_guess_ms']:>9.2f} {result['loss_surface_ms']:>9.2f} "
+              f"{result['warp_ms']:>9.3f} {d_score:>9.2e} {d_grad:>9.2e} {d_corners:>9.2e}")
+
+    report(f'riferimento ({default_threads})', reference)
+    for name, profile in configs:
+        util.apply_cpu_profile(**dict(dict(threads=default_threads, channels_last=False, bf16_autocast=False), **profile))
+        report(name, run_config(opt, frame, template, corners, args.freeze, args.repeats))
+    util.apply_cpu_profile(threads=default_threads, channels_last=False, bf16_autocast=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+"""
+Benchmark end-to-end della pipeline di `ModelManager` sulle immagini di `data/`.
+
+Ogni immagine attraversa tutti gli step (selezione/decodifica, detection +
+classificazione + predizione dell'attacco, omografia + fuorigioco).
+Per ogni step si misurano:
+    - latenza a freddo (prima esecuzione nel processo, caricamento modelli incluso);
+    - latenza a caldo (media, p50, p95 sulle esecuzioni successive);
+    - throughput a caldo (esecuzioni al secondo);
+    - picco di memoria residente (RSS) osservato durante lo step.
+
+Il report puo' essere salvato come baseline e confrontato con le esecuzioni
+successive: se un tempo a caldo peggiora oltre la tolleranza il processo esce
+con codice 1, cosi' il benchmark si puo' usare per accettare o rifiutare una
+modifica. La baseline dipende dalla macchina e non e' versionata: va creata
+con --save-baseline; con --require-baseline la sua assenza e' un errore.
+I tempi a freddo e la memoria (che include il caricamento dei modelli) sono
+solo riportati, non confrontati.
+
+Richiede psutil (extra 'bench': pip install -e ".[bench]").
+
+Uso:
+    python -m benchmarks.bench_pipeline --repeats 3 --save-baseline
+    python -m benchmarks.bench_pipeline --repeats 3 --tolerance 0.1 --require-baseline
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import psutil
+
+from main_model import ModelManager
+from offside.homography_cache import HomographyCache
+from pipeline.artifacts import DiskSink
+from sportsfield_release.utils import profiling
+
+DEFAULT_IMAGES = [os.path.join('data', 'test*.png'), os.path.join('data', 'test_image*.jpg')]
+DEFAULT_BASELINE = os.path.join('benchmarks', 'baseline.json')
+DEFAULT_OUTPUT = os.path.join('results', 'benchmark.json')
+STAGES = ('select_image', 'attack_prediction', 'offside_detection')
+
+
+class RssSampler:
+    """
+    Campiona in background la memoria residente del processo.
+    `peak()` ritorna il massimo osservato dall'ultimo `reset()`.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self._process = psutil.Process()
+        self._interval = interval
+        self._peak = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='rss-sampler', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._sample()
+            self._stop.wait(self._interval)
+
+    def _sample(self) -> int:
+        rss = self._process.memory_info().rss
+        with self._lock:
+            self._peak = max(self._peak, rss)
+        return rss
+
+    def reset(self) -> None:
+        with self._lock:
+            self._peak = 0
+        self._sample()
+
+    def peak(self) -> int:
+        self._sample()
+        with self._lock:
+            return self._peak
+
+
+def list_images(patterns: list[str]) -> list[str]:
+    return sorted({path for pattern in patterns for path in glob.glob(pattern)})
+
+
+def run_benchmark(images: list[str], repeats: int, use_cache: bool = False) -> dict:
+    """
+    Esegue `repeats` passate su tutte le immagini con un unico ModelManager.
+    La prima esecuzione di ogni step e' quella a freddo, le altre a caldo.
+    Senza `use_cache` la cache delle omografie viene svuotata prima di ogni
+    immagine, cosi' si misura sempre l'ottimizzazione.
+    """
+    samples = {name: [] for name in STAGES}
+    peaks = {name: 0 for name in STAGES}
+    pipeline_seconds = []
+
+    def timed(name, fn, *args):
+        sampler.reset()
+        start = time.perf_counter()
+        result = fn(*args)
+        samples[name].append(time.perf_counter() - start)
+        peaks[name] = max(peaks[name], sampler.peak())
+        return result
+
+    # Cache e artefatti in una cartella temporanea, rimossa a fine esecuzione
+    with tempfile.TemporaryDirectory(prefix='offside-bench-') as work_dir:
+        cache = HomographyCache(os.path.join(work_dir, 'homography_cache'))
+        sink = DiskSink(os.path.join(work_dir, 'artifacts'))
+        manager = ModelManager(homography_cache=cache, sink=sink)
+        # Le scritture in background devono finire prima che la cartella venga rimossa
+        try:
+            with RssSampler() as sampler:
+                for _ in range(repeats):
+                    for path in images:
+                        if not use_cache:
+                            cache.clear()
+                        start = time.perf_counter()
+                        with open(path, 'rb') as f:
+                            timed('select_image', manager.step_select_image, f)
+                        timed('attack_prediction', manager.step_attack_prediction)
+                        timed('offside_detection', manager.step_offside_detection, 'Team A')
+                        pipeline_seconds.append(time.perf_counter() - start)
+        finally:
+            sink.close()
+
+    report = {'stages': {}}
+    for name in STAGES:
+        warm = np.array(samples[name][1:])
+        report['stages'][name] = {
+            'cold_ms': samples[name][0] * 1e3,
+            'warm_mean_ms': float(warm.mean() * 1e3) if warm.size else None,
+            'warm_p50_ms': float(np.percentile(warm, 50) * 1e3) if warm.size else None,
+            'warm_p95_ms': float(np.percentile(warm, 95) * 1e3) if warm.size else None,
+            'warm_throughput': float(warm.size / warm.sum()) if warm.size else None,
+            'peak_rss_mb': peaks[name] / 2 ** 20,
+        }
+    warm_pipeline = np.array(pipeline_seconds[1:])
+    report['pipeline'] = {
+        'cold_ms': pipeline_seconds[0] * 1e3,
+        'warm_mean_ms': float(warm_pipeline.mean() * 1e3) if warm_pipeline.size else None,
+        'warm_throughput': float(warm_pipeline.size / warm_pipeline.sum()) if warm_pipeline.size else None,
+        'peak_rss_mb': max(peaks.values()) / 2 ** 20,
+    }
+    return report
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Confronta i tempi a caldo del report con la baseline; ritorna l'elenco
+    delle regressioni (latenza cresciuta o throughput calato oltre la tolleranza).
+    I tempi a freddo misurano soprattutto il caricamento dei modelli e il disco.
+    """
+    regressions = []
+    entries = dict(report['stages'], pipeline=report['pipeline'])
+    base_entries = dict(baseline['stages'], pipeline=baseline['pipeline'])
+    for name, current in entries.items():
+        base = base_entries.get(name)
+        if base is None:
+            continue
+        for metric, value in current.items():
+            reference = base.get(metric)
+            if not metric.startswith('warm_') or value is None or not reference:
+                continue
+            if metric == 'warm_throughput':
+                worse = value < reference * (1 - tolerance)
+            else:
+                worse = value > reference * (1 + tolerance)
+            if worse:
+                regressions.append(f'{name}.{metric}: {value:.2f} (baseline {reference:.2f})')
+    return regressions
+
+
+def print_report(report: dict) -> None:
+    print(f"{'step':>20} {'cold ms':>10} {'warm p50':>10} {'warm p95':>10} {'it/s':>8} {'RSS MB':>8}")
+    for name, stats in dict(report['stages'], pipeline=report['pipeline']).items():
+        def fmt(key, spec='.2f'):
+            value = stats.get(key)
+            return format(value, spec) if value is not None else '-'
+        print(f"{name:>20} {fmt('cold_ms'):>10} {fmt('warm_p50_ms'):>10} {fmt('warm_p95_ms'):>10} "
+              f"{fmt('warm_throughput'):>8} {fmt('peak_rss_mb', '.0f'):>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark della pipeline sul dataset di test in data/.')
+    parser.add_argument('--images', nargs='+', default=DEFAULT_IMAGES, help='glob delle immagini')
+    parser.add_argument('--repeats', type=int, default=2, help='passate su tutte le immagini')
+    parser.add_argument('--use-cache', action='store_true', help='riusa le omografie gia\' calcolate')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='file JSON del report')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='file JSON della baseline')
+    parser.add_argument('--save-baseline', action='store_true', help='salva il report come nuova baseline')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='peggioramento relativo tollerato')
+    parser.add_argument('--require-baseline', action='store_true',
+                        help='esce con errore se la baseline non esiste invece di saltare il confronto')
+    args = parser.parse_args()
+
+    images = list_images(args.images)
+    if not images:
+        parser.error(f'nessuna immagine trovata in {args.images}')
+    # Controllato prima di eseguire il benchmark, che richiede minuti
+    if args.require_baseline and not args.save_baseline and not os.path.exists(args.baseline):
+        parser.error(f'nessuna baseline in {args.baseline}: creala con --save-baseline')
+
+    profiling.enable()
+    report = run_benchmark(images, args.repeats, args.use_cache)
+    report['substages'] = profiling.summary()
+    report['environment'] = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'images': images,
+        'repeats': args.repeats,
+        'use_cache': args.use_cache,
+    }
+
+    print_report(report)
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Report salvato in: {args.output}')
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Baseline salvata in: {args.baseline}')
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f'ATTENZIONE: nessuna baseline in {args.baseline}, confronto delle regressioni SALTATO. '
+              f'Usa --save-baseline per crearla.')
+        return
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    regressions = compare(report, baseline, args.tolerance)
+    if regressions:
+        print(f'Regressioni oltre il {args.tolerance:.0%}:')
+        for regression in regressions:
+            print(f'  {regression}')
+        sys.exit(1)
+    print(f'Nessuna regressione oltre il {args.tolerance:.0%} rispetto alla baseline.')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,14 +3,17 @@ import numpy as np
 from sklearn.cluster import KMeans
 import math
 
+from sportsfield_release.utils import profiling
+
 def compute_distance(color1, color2):
     """Calcola distanza euclidea tra due colori """
     return math.sqrt((color2[0]-color1[0])**2 + (color2[1]-color1[1])**2 + (color2[2]-color1[2])**2)
 
-def extract_mean_color(bounding_box_player):
+def extract_mean_color(bounding_box_player, bounding_box_hsv=None):
     
     # mask green
-    bounding_box_hsv = cv2.cvtColor(bounding_box_player, cv2.COLOR_BGR2HSV)
+    if bounding_box_hsv is None:
+        bounding_box_hsv = cv2.cvtColor(bounding_box_player, cv2.COLOR_BGR2HSV)
     mask_green = cv2.inRange(bounding_box_hsv, (36,25,25), (70,255,255))
     
     mask_green_inv = cv2.bitwise_not(mask_green)
@@ -19,32 +22,37 @@ def extract_mean_color(bounding_box_player):
     mean_color = np.array(cv2.mean(bounding_box_player, mask=mask_green_inv))
     return mean_color[:3]
 
+@profiling.timed('kmeans')
 def get_dominant_colors(team_colors):
     colors_kmeans = KMeans(n_clusters=2)
     colors_kmeans.fit(team_colors)
     return colors_kmeans
 
-def team_classification_complete(boxes, classes, image):
+def team_classification_complete(boxes, classes, frame):
     
+    # Vista HSV calcolata una sola volta per tutto il frame
+    image, image_hsv = frame.bgr, frame.hsv
+
     # Estrai box per tipo 
     players_boxes = []
     goalkeeper_box = []
     team_colors = []
     ball_box = []
     
-    for box, cls in zip(boxes, classes):
-        if round(cls) == 0:  # classe 0 = player
-            x1, y1, x2, y2 = map(int, box)
-            players_boxes.append([x1, y1, x2, y2])
-            player = image[y1:y2, x1:x2]  # RITAGLIO DELL'IMMAGINE
-            color = extract_mean_color(player)  # Passa il ritaglio, non le coordinate
-            team_colors.append(color)
-        if round(cls) == 1:  # classe 1 = goalkeeper
-            x1, y1, x2, y2 = map(int, box)
-            goalkeeper_box.append([x1, y1, x2, y2])
-        if round(cls) == 2:  # classe 2 = ball
-            x1, y1, x2, y2 = map(int, box)
-            ball_box.append([x1, y1, x2, y2])
+    with profiling.stage('colour_extraction'):
+        for box, cls in zip(boxes, classes):
+            if round(cls) == 0:  # classe 0 = player
+                x1, y1, x2, y2 = map(int, box)
+                players_boxes.append([x1, y1, x2, y2])
+                player = image[y1:y2, x1:x2]  # RITAGLIO DELL'IMMAGINE
+                color = extract_mean_color(player, image_hsv[y1:y2, x1:x2])  # Passa il ritaglio, non le coordinate
+                team_colors.append(color)
+            if round(cls) == 1:  # classe 1 = goalkeeper
+                x1, y1, x2, y2 = map(int, box)
+                goalkeeper_box.append([x1, y1, x2, y2])
+            if round(cls) == 2:  # classe 2 = ball
+                x1, y1, x2, y2 = map(int, box)
+                ball_box.append([x1, y1, x2, y2])
     
     # KMeans sui colori 
     kmeans_colors = get_dominant_colors(team_colors)
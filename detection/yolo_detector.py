@@ -0,0 +1,73 @@
+import threading
+
+import numpy as np
+from ultralytics import YOLO
+
+from sportsfield_release.utils import profiling
+
+DEFAULT_MODEL_PATH = "model/teamClassification/weights/best.pt"
+
+
+class DetectorSession:
+    """
+    Sessione YOLO a lunga vita.
+    I pesi vengono caricati una sola volta, il modello viene "scaldato"
+    con un frame fittizio e poi riusato per ogni chiamata, sia su
+    singola immagine che su una lista di frame (inferenza in batch).
+    """
+
+    _model_path: str
+    _model: YOLO
+    _max_batch_size: int
+    _warmup_shape: tuple
+
+    def __init__(self, model_path: str = DEFAULT_MODEL_PATH, max_batch_size: int = 8,
+                 warmup_shape: tuple = (640, 640, 3)):
+        self._model_path = model_path
+        self._max_batch_size = max(1, max_batch_size)
+        self._warmup_shape = warmup_shape
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+    def warm_up(self) -> None:
+        """
+        Carica i pesi (se necessario) ed esegue un'inferenza su un frame nero,
+        in modo che la prima immagine reale non paghi il setup del grafo.
+        """
+        if self._model is not None:
+            return
+        with self._lock:
+            if self._model is not None:
+                return
+            with profiling.stage('yolo_warmup'):
+                model = YOLO(self._model_path)
+                model(np.zeros(self._warmup_shape, dtype=np.uint8), verbose=False)
+            self._model = model
+
+    def detect(self, image) -> tuple[list, list]:
+        """
+        Esegue la detection su una singola immagine (Frame, array BGR o percorso).
+        Ritorna le bounding box (xyxy) e le classi.
+        """
+        return self.detect_batch([image])[0]
+
+    def detect_batch(self, images: list) -> list[tuple[list, list]]:
+        """
+        Esegue la detection su una lista di immagini con una sola chiamata
+        al modello per ogni blocco di `max_batch_size` frame.
+        Ritorna una lista di coppie (boxes, classes) nello stesso ordine.
+        """
+        self.warm_up()
+        detections = []
+        for start in range(0, len(images), self._max_batch_size):
+            # I Frame vengono passati gia' decodificati, senza rileggerli da disco
+            chunk = [getattr(image, 'bgr', image) for image in images[start:start + self._max_batch_size]]
+            with profiling.stage('yolo'):
+                results = self._model(chunk, verbose=False)
+            for result in results:
+                detections.append((result.boxes.xyxy.tolist(), result.boxes.cls.tolist()))
+        return detections
@@ -1,15 +1,17 @@
 import os
 import cv2
-from ultralytics import YOLO
+from detection.yolo_detector import DetectorSession
 from color_clustering.clustering import team_classification_complete
-from analysis.attack_prediction import predictTeamAttacking
-from visualization.visualize import draw_boxes, save_image
-from offside.homography_calculator import calculateOptimHomography, load_homography, save_homography
-from offside.offside_detection import drawOffside
+from analysis.attack_prediction import predictTeamAttacking, assignTeamNames
+from visualization.visualize import draw_boxes
+from offside.homography_calculator import calculateOptimHomography, buildOptions, cacheOptions
+from offside.homography_cache import HomographyCache
+from offside.offside_detection import drawOffside, getOverlayAssets
+from pipeline.frame import Frame
+from pipeline.artifacts import ArtifactSink, DiskSink, job_directory
 
 import os
 from io import BufferedReader
-from numpy import frombuffer, uint8
 
 
 
@@ -17,27 +19,61 @@ class ModelManager:
 
     _image_path: str
     _image: cv2.typing.MatLike
+    _frame: Frame
 
     _player_classification: dict
     _color_classification: dict
     _percent_team1: float
     _percent_team2: float
 
+    _detector: DetectorSession
+    _homography_cache: HomographyCache
+    _sink: ArtifactSink
+
+    def __init__(self, detector: DetectorSession = None, homography_cache: HomographyCache = None,
+                 sink: ArtifactSink = None):
+        """
+        Il detector YOLO viene creato una sola volta e riusato
+        per tutte le immagini analizzate da questo modello.
+        Le omografie calcolate vengono salvate in una cache indicizzata
+        per contenuto del frame.
+        Le immagini prodotte vanno nel sink indicato; di default ogni immagine
+        selezionata ha la propria cartella in `results`, scritta in background.
+        """
+        self._detector = detector if detector is not None else DetectorSession()
+        self._homography_cache = homography_cache if homography_cache is not None else \
+            HomographyCache(os.path.join('results', 'homography_cache'))
+        self._homography_options = cacheOptions(buildOptions())
+        self._fixed_sink = sink
+        self._sink = sink
+
+    def warm_up(self):
+        """ Carica e scalda il detector e gli asset del disegno, utile da chiamare in background all'avvio. """
+        self._detector.warm_up()
+        getOverlayAssets()
+
     def step_select_image(self, buffered_image: BufferedReader):
         """
         Questa funzione prende il percorso dell'immagine selezionata dalla GUI.
         Ritorna l'immagine caricata o None se impossibile caricarla.
         """
-        image_data = buffered_image.read()
-        np_arr = frombuffer(image_data, uint8)
-        image = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-        if image is None:
+        # Il frame viene decodificato una sola volta e condiviso da tutti gli step
+        frame = Frame.from_bytes(buffered_image.read(), buffered_image.name)
+        try:
+            image = frame.bgr
+        except ValueError:
             print("Immagine non trovata.")
+            image = None
             
         self._image_path = buffered_image.name
         self._image = image
-        self._results_dir = 'results'
-        os.makedirs(self._results_dir, exist_ok=True)
+        self._frame = frame
+
+        # Ogni immagine e' un job con la propria cartella dei risultati
+        if self._fixed_sink is None:
+            if self._sink is not None:
+                self._sink.close()
+            self._sink = DiskSink(job_directory())
 
 
     def step_attack_prediction(self):
@@ -46,45 +82,64 @@ class ModelManager:
         calcola le percentuali di attacco e ritorna la classificazione
         di giocatori, colori e le percentuali di attacco.
         """
-        model_path = "model/teamClassification/weights/best.pt"
-        model = YOLO(model_path)
-        results = model(self._image_path)
-        os.makedirs(self._results_dir, exist_ok=True)
-
-        
-        boxes, classes = results[0].boxes.xyxy.tolist(), results[0].boxes.cls.tolist()
-
-        self._players_classification, self._color_classification = team_classification_complete(boxes, classes, self._image)
-        percent_team_1, percent_team_2 = predictTeamAttacking(self._players_classification, self._image)
-        
-        if percent_team_1 > percent_team_2:
-            attacking_team_name = "Team A"
-            defending_team_name = "Team B"
-            self._players_classification['Team A'] = self._players_classification.pop(0)
-            self._players_classification['Team B'] = self._players_classification.pop(1)
-        else:
-            attacking_team_name = "Team B"
-            defending_team_name = "Team A"
-            self._players_classification['Team B'] = self._players_classification.pop(0)
-            self._players_classification['Team A'] = self._players_classification.pop(1)
+        boxes, classes = self._detector.detect(self._frame)
+
+        self._players_classification, self._color_classification, _, _ = \
+            self._classify_and_predict_attack(self._frame, boxes, classes, self._sink)
+
         annotated_image = draw_boxes(self._image, boxes, classes, self._players_classification)
-        save_image(annotated_image, os.path.join(self._results_dir, 'final_annotated_result.jpg'))
+        result_path = self._sink.write('final_annotated_result.jpg', annotated_image)
 
-        return os.path.join(self._results_dir, 'final_annotated_result.jpg')
+        # La GUI legge subito l'immagine: si attende la fine delle scritture
+        self._sink.flush()
+        return result_path
+
+    def step_attack_prediction_batch(self, images: list) -> list[dict]:
+        """
+        Esegue detection (in un'unica inferenza batch), classificazione
+        e predizione dell'attacco su una lista di frame (o immagini BGR).
+        Ritorna, per ogni immagine, un dizionario con classificazione
+        dei giocatori, colori delle squadre e percentuali di attacco.
+        """
+        frames = [image if isinstance(image, Frame) else Frame.from_array(image) for image in images]
+        results = []
+        for frame, (boxes, classes) in zip(frames, self._detector.detect_batch(frames)):
+            players_classification, color_classification, percent_team_1, percent_team_2 = \
+                self._classify_and_predict_attack(frame, boxes, classes)
+            results.append({
+                'boxes': boxes,
+                'classes': classes,
+                'players_classification': players_classification,
+                'color_classification': color_classification,
+                'percent_team_1': percent_team_1,
+                'percent_team_2': percent_team_2,
+            })
+        return results
+
+    def _classify_and_predict_attack(self, frame: Frame, boxes, classes, sink: ArtifactSink = None):
+        """
+        Classifica i giocatori per colore, calcola le percentuali di attacco
+        e rinomina le squadre in 'Team A' / 'Team B'.
+        """
+        players_classification, color_classification = team_classification_complete(boxes, classes, frame)
+        percent_team_1, percent_team_2 = predictTeamAttacking(players_classification, frame.bgr, sink)
+        assignTeamNames(players_classification, percent_team_1, percent_team_2)
+
+        return players_classification, color_classification, percent_team_1, percent_team_2
 
     def step_offside_detection(self, attacking_team_from_user):
         """
         Calcola o carica l'omografia, rileva il fuorigioco e salva l'immagine annotata.
         Ritorna il numero di giocatori in fuorigioco.
         """
-        homography_path = os.path.join(self._results_dir, 'homography.pt')
-        if os.path.exists(homography_path):
-            print("Caricando omografia esistente...")
-            homography = load_homography(homography_path)
+        cache_key = HomographyCache.make_key(self._image, self._homography_options)
+        homography = self._homography_cache.get(cache_key)
+        if homography is not None:
+            print("Omografia trovata in cache.")
         else:
             print("Calcolando nuova omografia...")
-            homography = calculateOptimHomography(self._image_path)
-            save_homography(homography, homography_path)
+            homography = calculateOptimHomography(self._frame)
+            self._homography_cache.put(cache_key, homography)
 
         attacking_team = "Team A" if attacking_team_from_user == "Team A" else "Team B"
         defending_team = "Team B" if attacking_team == "Team A" else "Team A"
@@ -95,10 +150,16 @@ class ModelManager:
         defender_boxes = self._players_classification.get(defending_team, [])
         goalkeeper_boxes = self._players_classification.get('goalkeeper', [])
 
-        offside_count = drawOffside(self._image_path, attacking_team, self._color_classification, homography,
-                                defender_boxes, attacker_boxes, goalkeeper_boxes)
+        offside_count = drawOffside(self._frame, attacking_team, self._color_classification, homography,
+                                defender_boxes, attacker_boxes, goalkeeper_boxes, self._sink)
 
         print(f"Numero di giocatori in fuorigioco: {offside_count}")
 
-        # Salva immagine annotata
-        return os.path.join(self._results_dir, 'offside_3D.jpg')
+        # Attende il salvataggio dell'immagine annotata
+        self._sink.flush()
+        return self._artifact_path('offside_3D.jpg')
+
+    def _artifact_path(self, name: str) -> str:
+        """ Percorso dell'artefatto se il sink scrive su disco, altrimenti il suo nome. """
+        directory = getattr(self._sink, 'directory', None)
+        return os.path.join(directory, name) if directory else name
@@ -1,34 +1,175 @@
-import torch
+"""
+Proiezioni pixel <-> campo 2D e formato su disco delle omografie.
+Usa solo NumPy: lo stadio del fuorigioco (decisione e disegno) non dipende da
+torch, che serve solo a calcolare le omografie. I tensori torch in ingresso
+sono comunque accettati.
+"""
+import json
+import os
+
 import numpy as np
 
-def convertPoint3Dto2D(homography: torch.Tensor, p: list[int], w: int, h: int) -> list[float]:
+# Dimensioni del campo 2D (template) in pixel
+PITCH_WIDTH, PITCH_HEIGHT = 1050, 680
+
+# Formato portabile delle omografie salvate (JSON)
+HOMOGRAPHY_FORMAT = 'offside-homography'
+HOMOGRAPHY_FORMAT_VERSION = 1
+
+
+def isTensor(value) -> bool:
+    """Vero per i tensori torch, senza importare torch."""
+    return type(value).__module__.startswith('torch')
+
+
+def asHomographyArray(homography) -> np.ndarray:
+    """Omografia 3x3 float64 da tensore torch (anche su GPU o con gradiente), array o lista."""
+    if isTensor(homography):
+        homography = homography.detach().cpu().numpy()
+    return np.asarray(homography, dtype=np.float64).reshape(3, 3)
+
+
+def normalizationMatrix(w: float, h: float) -> np.ndarray:
+    """Da pixel di un'immagine w x h a coordinate normalizzate in [-0.5, 0.5]."""
+    return np.array([[1.0 / w, 0.0, -0.5],
+                     [0.0, 1.0 / h, -0.5],
+                     [0.0, 0.0, 1.0]])
+
+
+def denormalizationMatrix(w: float, h: float) -> np.ndarray:
+    """Da coordinate normalizzate in [-0.5, 0.5] a pixel di un'immagine w x h."""
+    return np.array([[w, 0.0, w / 2],
+                     [0.0, h, h / 2],
+                     [0.0, 0.0, 1.0]])
+
+
+def imageToPitchMatrix(homography, w: int, h: int) -> np.ndarray:
+    """
+    Compone normalizzazione, omografia e scala del campo in un'unica matrice 3x3:
+    pixel dell'immagine w x h -> pixel del campo 2D (1050x680).
+    """
+    return denormalizationMatrix(PITCH_WIDTH, PITCH_HEIGHT) @ asHomographyArray(homography) @ normalizationMatrix(w, h)
+
+
+def projectPoints(matrix: np.ndarray, points) -> np.ndarray:
+    """Applica una matrice 3x3 a N punti (N, 2), con divisione prospettica."""
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    projected = points @ matrix[:, :2].T + matrix[:, 2]
+    return projected[:, :2] / projected[:, 2:]
+
+
+def projectPointsTorch(matrix, points):
+    """Come `projectPoints`, per tensori torch (N, 2); la matrice segue device e dtype dei punti."""
+    matrix = points.new_tensor(np.asarray(matrix))
+    points = points.reshape(-1, 2)
+    projected = points @ matrix[:, :2].T + matrix[:, 2]
+    return projected[:, :2] / projected[:, 2:]
+
+
+class PitchProjection:
+    """
+    Proiezione pixel <-> campo 2D per un'omografia e una dimensione dell'immagine.
+    La matrice pixel -> campo viene composta una volta sola, l'inversa
+    (campo -> pixel) viene calcolata alla prima richiesta e tenuta in cache.
+    I punti possono essere liste, array NumPy o tensori (N, 2): i tensori
+    restano tensori.
+    """
+
+    def __init__(self, homography, w: int, h: int):
+        self.image_to_pitch = imageToPitchMatrix(homography, w, h)
+        self._pitch_to_image = None
+
+    @property
+    def pitch_to_image(self) -> np.ndarray:
+        if self._pitch_to_image is None:
+            self._pitch_to_image = np.linalg.inv(self.image_to_pitch)
+        return self._pitch_to_image
+
+    @staticmethod
+    def _project(matrix: np.ndarray, points):
+        if isTensor(points):
+            return projectPointsTorch(matrix, points)
+        return projectPoints(matrix, points)
+
+    def toPitch(self, points):
+        """Pixel dell'immagine -> pixel del campo 2D."""
+        return self._project(self.image_to_pitch, points)
+
+    def toImage(self, points):
+        """Pixel del campo 2D -> pixel dell'immagine."""
+        return self._project(self.pitch_to_image, points)
+
+
+def convertPoint3Dto2D(homography, p: list[int], w: int, h: int) -> list[float]:
     """Converte un punto dall'immagine 3D al campo 2D usando omografia."""
-    x = torch.tensor(p[0] / w - 0.5).float()
-    y = torch.tensor(p[1] / h - 0.5).float()
-    xy = torch.stack([x, y, torch.ones_like(x)])
-    xy_warped = torch.matmul(homography.cpu(), xy)
-    xy_warped, z_warped = xy_warped.split(2, dim=1)
-    
-    xy_warped = 2.0 * xy_warped / (z_warped + 1e-8)
-    x_warped, y_warped = torch.unbind(xy_warped, dim=1)
-    
-    x_warped = (x_warped.item() * 0.5 + 0.5) * 1050
-    y_warped = (y_warped.item() * 0.5 + 0.5) * 680
-    
-    return [x_warped, y_warped]
-
-def convertPoint2Dto3D(homography: torch.Tensor, p: list[int], w: int, h: int) -> list[float]:
-    """Converte un punto dal campo 2D all'immagine 3D usando omografia inversa."""
-    x = torch.tensor(p[0] / 1050 - 0.5).float()
-    y = torch.tensor(p[1] / 680 - 0.5).float()
-    xy = torch.stack([x, y, torch.ones_like(x)])
-    xy_warped = torch.matmul(homography.cpu(), xy)
-    xy_warped, z_warped = xy_warped.split(2, dim=1)
-    
-    xy_warped = 2.0 * xy_warped / (z_warped + 1e-8)
-    x_warped, y_warped = torch.unbind(xy_warped, dim=1)
-    
-    x_warped = (x_warped.item() * 0.5 + 0.5) * w
-    y_warped = (y_warped.item() * 0.5 + 0.5) * h
-    
-    return [x_warped, y_warped]
+    return projectPoints(imageToPitchMatrix(homography, w, h), [p[:2]])[0].tolist()
+
+
+def convertPoint2Dto3D(homography, p: list[int], w: int, h: int) -> list[float]:
+    """
+    Converte un punto dal campo 2D all'immagine 3D usando omografia inversa.
+    Per piu' punti usare `PitchProjection.toImage`, che non richiede l'inversa.
+    """
+    matrix = denormalizationMatrix(w, h) @ asHomographyArray(homography) @ normalizationMatrix(PITCH_WIDTH, PITCH_HEIGHT)
+    return projectPoints(matrix, [p[:2]])[0].tolist()
+
+
+def homographyToRecord(homography, metadata: dict = None) -> dict:
+    """Record JSON dell'omografia: matrice 3x3, forma originale e metadati."""
+    shape = list(getattr(homography, 'shape', (3, 3)))
+    return {
+        'format': HOMOGRAPHY_FORMAT,
+        'version': HOMOGRAPHY_FORMAT_VERSION,
+        'shape': [int(n) for n in shape],
+        'matrix': asHomographyArray(homography).tolist(),
+        'metadata': metadata or {},
+    }
+
+
+def homographyFromRecord(record: dict) -> np.ndarray:
+    """Omografia (float32, con la forma originale) da un record di `homographyToRecord`."""
+    if record.get('format') != HOMOGRAPHY_FORMAT:
+        raise ValueError(f"Formato omografia non riconosciuto: {record.get('format')}")
+    if record.get('version', 0) > HOMOGRAPHY_FORMAT_VERSION:
+        raise ValueError(f"Versione del formato omografia non supportata: {record['version']}")
+    matrix = np.asarray(record['matrix'], dtype=np.float32)
+    return matrix.reshape(record.get('shape', (3, 3)))
+
+
+def writeHomography(homography, path: str, metadata: dict = None) -> None:
+    """Scrive l'omografia: JSON con metadati, oppure matrice NumPy se il file e' .npy."""
+    if path.endswith('.npy'):
+        with open(path, 'wb') as f:
+            np.save(f, asHomographyArray(homography).astype(np.float32))
+        return
+    with open(path, 'w') as f:
+        json.dump(homographyToRecord(homography, metadata), f)
+
+
+def readHomography(path: str) -> np.ndarray:
+    """
+    Legge un'omografia scritta da `writeHomography`.
+    I vecchi file .pt (torch.save) sono ancora letti: solo in quel caso si importa torch.
+    """
+    extension = os.path.splitext(path)[1]
+    if extension == '.npy':
+        return np.load(path)
+    if extension == '.pt':
+        import torch
+        homography = torch.load(path, map_location='cpu')
+        return asHomographyArray(homography).astype(np.float32).reshape(tuple(homography.shape))
+    with open(path, 'r') as f:
+        return homographyFromRecord(json.load(f))
+
+
+def save_homography(homography, save_path: str, metadata: dict = None):
+    """Salva la matrice di omografia su disco (JSON, o .npy), senza torch."""
+    writeHomography(homography, save_path, metadata)
+    print(f"Omografia salvata in: {save_path}")
+
+
+def load_homography(load_path: str) -> np.ndarray:
+    """Carica la matrice di omografia da disco (JSON, .npy o il vecchio .pt)."""
+    homography = readHomography(load_path)
+    print(f"Omografia caricata da: {load_path}")
+    return homography
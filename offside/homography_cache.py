@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from offside.homography import isTensor, readHomography, writeHomography
+from sportsfield_release.utils import profiling
+
+# Formato attuale (JSON portabile) e vecchio formato (torch.save), ancora letto
+CACHE_EXTENSION = '.json'
+LEGACY_EXTENSION = '.pt'
+
+
+class HomographyCache:
+    """
+    Cache a due livelli (memoria + disco) delle omografie calcolate.
+
+    La chiave e' un hash del frame decodificato e delle opzioni di
+    ottimizzazione che influenzano il risultato, quindi due immagini diverse
+    non condividono mai la stessa omografia.
+    Entrambi i livelli hanno un limite di elementi (si scarta quello usato meno
+    di recente) e un'eta' massima oltre la quale l'elemento non e' piu' valido.
+    Su disco l'eta' e' la data di modifica del file e l'ultimo uso la data di
+    accesso: gli hit dal disco la aggiornano subito, quelli dalla memoria la
+    annotano e la scrivono solo prima di scartare voci dal disco o con `flush`,
+    cosi' un hit in memoria non fa I/O. L'ordine d'uso sopravvive ai riavvii. `get` ritorna sempre una copia, modificarla non altera la cache.
+    Su disco le omografie sono record JSON (vedi `offside.homography`), quindi
+    la cache si legge anche senza torch; le vecchie voci .pt restano leggibili.
+    """
+
+    def __init__(self, cache_dir: str = os.path.join('results', 'homography_cache'),
+                 max_memory_entries: int = 64, max_disk_entries: int = 1024,
+                 max_age_seconds: float = 30 * 24 * 3600):
+        self._cache_dir = cache_dir
+        self._max_memory_entries = max_memory_entries
+        self._max_disk_entries = max_disk_entries
+        self._max_age_seconds = max_age_seconds
+        self._memory = OrderedDict()
+        # Ultimi usi dalla memoria non ancora scritti su disco: percorso -> (accesso, creazione)
+        self._pending_access = {}
+        self._lock = threading.Lock()
+        self._stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+
+    @staticmethod
+    def make_key(image: np.ndarray, options: dict) -> str:
+        """Calcola la chiave del frame decodificato e delle opzioni."""
+        with profiling.stage('homography_cache_key'):
+            digest = hashlib.sha256()
+            digest.update(f'{image.shape}|{image.dtype}'.encode())
+            digest.update(np.ascontiguousarray(image).data)
+            digest.update(json.dumps(options, sort_keys=True, default=str).encode())
+            return digest.hexdigest()
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats['hits'] = stats['memory_hits'] + stats['disk_hits']
+        return stats
+
+    def _disk_path(self, key: str, extension: str = CACHE_EXTENSION) -> str:
+        return os.path.join(self._cache_dir, f'{key}{extension}')
+
+    def _expired(self, created: float) -> bool:
+        return time.time() - created > self._max_age_seconds
+
+    def get(self, key: str):
+        """Ritorna l'omografia associata alla chiave, o None se assente o scaduta."""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created, homography, path = entry
+                if not self._expired(created):
+                    self._memory.move_to_end(key)
+                    self._pending_access[path] = (time.time(), created)
+                    self._stats['memory_hits'] += 1
+                    return homography.copy()
+                del self._memory[key]
+                self._stats['evictions'] += 1
+
+            for extension in (CACHE_EXTENSION, LEGACY_EXTENSION):
+                path = self._disk_path(key, extension)
+                try:
+                    created = os.path.getmtime(path)
+                    if not self._expired(created):
+                        with profiling.stage('homography_cache_io'):
+                            homography = readHomography(path)
+                        self._remember(key, created, homography, path)
+                        self._touch(path, time.time(), created)
+                        self._stats['disk_hits'] += 1
+                        return homography.copy()
+                    os.remove(path)
+                    self._stats['evictions'] += 1
+                except FileNotFoundError:
+                    # Assente, oppure rimosso da un altro processo che condivide la cartella
+                    pass
+
+            self._stats['misses'] += 1
+            return None
+
+    def put(self, key: str, homography, metadata: dict = None) -> None:
+        """
+        Salva l'omografia in memoria e su disco.
+        In memoria si tiene la stessa matrice NumPy (float32) che si rilegge dal disco.
+        """
+        if isTensor(homography):
+            homography = homography.detach().cpu().numpy()
+        # Copia: la matrice del chiamante resta sua (e scrivibile)
+        homography = np.array(homography, dtype=np.float32)
+        with self._lock:
+            self._remember(key, time.time(), homography, self._disk_path(key))
+            os.makedirs(self._cache_dir, exist_ok=True)
+            # Scrittura atomica: altri processi non leggono mai un file a meta'
+            tmp_path = f'{self._disk_path(key)}.{os.getpid()}.tmp'
+            with profiling.stage('homography_cache_io'):
+                writeHomography(homography, tmp_path, metadata)
+                os.replace(tmp_path, self._disk_path(key))
+            self._evict_disk()
+
+    def flush(self) -> None:
+        """Scrive su disco gli ultimi usi delle voci lette dalla memoria."""
+        with self._lock:
+            self._flush_access()
+
+    def clear(self) -> None:
+        """Svuota entrambi i livelli della cache."""
+        with self._lock:
+            self._memory.clear()
+            self._pending_access.clear()
+            if os.path.isdir(self._cache_dir):
+                for name in os.listdir(self._cache_dir):
+                    if name.endswith((CACHE_EXTENSION, LEGACY_EXTENSION)):
+                        os.remove(os.path.join(self._cache_dir, name))
+
+    def _remember(self, key: str, created: float, homography: np.ndarray, path: str) -> None:
+        # Sola lettura: in memoria resta la copia di riferimento
+        homography.setflags(write=False)
+        self._memory[key] = (created, homography, path)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self._max_memory_entries:
+            self._memory.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def _flush_access(self) -> None:
+        pending, self._pending_access = self._pending_access, {}
+        for path, (accessed, created) in pending.items():
+            self._touch(path, accessed, created)
+
+    def _evict_disk(self) -> None:
+        entries = [os.path.join(self._cache_dir, name) for name in os.listdir(self._cache_dir)
+                   if name.endswith((CACHE_EXTENSION, LEGACY_EXTENSION))]
+        if len(entries) <= self._max_disk_entries:
+            return
+        # L'ordine d'uso deve comprendere gli hit in memoria
+        self._flush_access()
+        entries.sort(key=self._atime_or_zero)
+        for path in entries[:len(entries) - self._max_disk_entries]:
+            try:
+                os.remove(path)
+                self._stats['evictions'] += 1
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _touch(path: str, accessed: float, created: float) -> None:
+        """Segna l'ultimo uso nella data di accesso; la data di modifica (l'eta') resta invariata."""
+        try:
+            os.utime(path, (accessed, created))
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _atime_or_zero(path: str) -> float:
+        try:
+            return os.path.getatime(path)
+        except FileNotFoundError:
+            return 0.0
@@ -2,30 +2,16 @@ import os
 import numpy as np
 import torch
 import imageio
-from PIL import Image
 
+from pipeline.frame import Frame
 from sportsfield_release.utils import util
-from sportsfield_release.utils import image_utils, constant_var
+from sportsfield_release.utils import image_utils, constant_var, profiling
 from sportsfield_release.models import end_2_end_optimization
 from sportsfield_release.options import fake_options
 
 
-def calculateOptimHomography(imagePath: str) -> torch.Tensor:
-    """
-    Calcola la matrice di omografia ottimale per un'immagine di campo da calcio.
-    
-    Args:
-        imagePath (str): Percorso dell'immagine del campo
-        
-    Returns:
-        torch.Tensor: Matrice di omografia ottimizzata
-    """
-    # Configurazione GPU/CPU
-    constant_var.USE_CUDA = False
-    util.fix_randomness()
-    torch.backends.cudnn.enabled = True
-
-    # Configurazione opzioni
+def buildOptions(imagePath: str = None) -> fake_options.FakeOptions:
+    """Crea le opzioni di default per l'ottimizzazione end-to-end."""
     opt = fake_options.FakeOptions()
     opt.batch_size = 1
     opt.coord_conv_template = True
@@ -42,53 +28,202 @@ def calculateOptimHomography(imagePath: str) -> torch.Tensor:
     opt.need_spectral_norm_upstream = False
     opt.optim_criterion = 'l1loss'
     opt.optim_iters = 200
+    opt.optim_patience = 0
+    opt.optim_min_delta = 0.0
+    opt.optim_target_iou = None
+    opt.optim_time_budget = None
+    opt.optim_pyramid = None
     opt.optim_method = 'stn'
     opt.optim_type = 'adam'
+    opt.cpu_threads = None
+    opt.cpu_interop_threads = None
+    opt.channels_last = False
+    opt.bf16_autocast = False
+    opt.inference_freeze = True
+    # Il trace TorchScript e' facoltativo; se attivato va in cache fuori dai pesi versionati
+    opt.inference_trace = False
+    opt.inference_cache_dir = 'results/inference_cache'
     opt.out_dir = 'sportsfield_release/out'
     opt.prevent_neg = 'sigmoid'
     opt.template_path = 'sportsfield_release/data/world_cup_template.png'
     opt.warp_dim = 8
     opt.warp_type = 'homography'
+    return opt
+
+
+def cacheOptions(opt) -> dict:
+    """Estrae le opzioni che influenzano l'omografia calcolata."""
+    keys = ['optim_method', 'optim_type', 'optim_iters', 'lr_optim',
+            'load_weights_upstream', 'load_weights_error_model', 'tracking',
+            'optim_patience', 'optim_min_delta', 'optim_target_iou', 'optim_time_budget',
+            'optim_check_interval', 'optim_pyramid', 'lr_lbfgs', 'lbfgs_history',
+            'optim_hypotheses', 'hypothesis_sigma', 'bf16_autocast']
+    return {key: getattr(opt, key, None) for key in keys}
 
-    # Carica e preprocessa immagine obiettivo
-    goal_image = imageio.imread(opt.goal_image_path, pilmode='RGB')
-    
-    # Ridimensiona a 256x256 e normalizza
-    pil_image = Image.fromarray(np.uint8(goal_image))
-    pil_image = pil_image.resize([256, 256], resample=Image.NEAREST)
-    goal_image = np.array(pil_image)
-    
-    # Converte a tensor PyTorch e normalizza
-    goal_image = util.np_img_to_torch_img(goal_image)
-    if opt.need_single_image_normalization:
-        goal_image = image_utils.normalize_single_image(goal_image)
-    
-    print(f'Goal image - Mean: {goal_image.mean():.4f}, Std: {goal_image.std():.4f}')
 
-    # Carica e preprocessa template
+def prepareGoalImage(frame: Frame, opt) -> torch.Tensor:
+    """
+    Vista 256x256 normalizzata del frame, calcolata una sola volta per frame.
+    Il ridimensionamento usa la decodifica ridotta quando possibile.
+    """
+    def compute(frame):
+        goal_image = np.ascontiguousarray(frame.resized(256, 256)[..., ::-1])
+
+        # Converte a tensor PyTorch e normalizza
+        goal_image = util.np_img_to_torch_img(goal_image)
+        if opt.need_single_image_normalization:
+            goal_image = image_utils.normalize_single_image(goal_image)
+        return goal_image
+
+    return frame.view(('goal_image', opt.need_single_image_normalization), compute)
+
+
+def prepareTemplateImage(opt) -> torch.Tensor:
+    """Carica e preprocessa il template del campo."""
     template_image = imageio.imread(opt.template_path, pilmode='RGB')
     template_image = template_image / 255.0
     if opt.coord_conv_template:
         template_image = image_utils.rgb_template_to_coord_conv_template(template_image)
-    
+
     template_image = util.np_img_to_torch_img(template_image)
     if opt.need_single_image_normalization:
         template_image = image_utils.normalize_single_image(template_image)
+    return template_image
+
+
+class HomographyEstimator:
+    """
+    Stima dell'omografia con modelli caricati una sola volta.
+    Opzioni, template e rete end-to-end vengono creati nel costruttore
+    e riusati per ogni immagine.
+    Con `tracking=True` ogni stima parte dall'omografia del frame precedente
+    (utile per i video), con poche iterazioni di raffinamento.
+    """
+
+    def __init__(self, **overrides):
+        # Configurazione GPU/CPU
+        constant_var.USE_CUDA = False
+        util.fix_randomness()
+        torch.backends.cudnn.enabled = True
+
+        self.opt = buildOptions()
+        for key, value in overrides.items():
+            setattr(self.opt, key, value)
+        # Profilo CPU (thread, channels_last, bf16): globale al processo, prima di creare le reti
+        util.apply_cpu_profile(self.opt.cpu_threads, self.opt.cpu_interop_threads,
+                               self.opt.channels_last, self.opt.bf16_autocast)
 
-    # Inizializza e esegue ottimizzazione end-to-end
-    e2e = end_2_end_optimization.End2EndOptimFactory.get_end_2_end_optimization_model(opt)
-    orig_homography, optim_homography = e2e.optim(goal_image[None], template_image)
+        self.template_image = prepareTemplateImage(self.opt)
+        self.e2e = end_2_end_optimization.End2EndOptimFactory.get_end_2_end_optimization_model(self.opt)
+        # Piramide del template calcolata una volta sola: il template non cambia tra i frame
+        self.e2e.prepare_template_pyramid(self.template_image)
+
+    def estimate(self, frame: Frame, initial_guess: torch.Tensor = None) -> torch.Tensor:
+        """
+        Calcola l'omografia ottimizzata per un frame.
+        `initial_guess` e' l'omografia iniziale gia' calcolata con `initial_guess_batch`;
+        se assente viene inferita qui.
+        """
+        goal_image = prepareGoalImage(frame, self.opt)
+        print(f'Goal image - Mean: {goal_image.mean():.4f}, Std: {goal_image.std():.4f}')
+
+        if initial_guess is not None:
+            initial_guess = initial_guess.reshape(1, 3, 3)
+        with profiling.stage('homography'):
+            orig_homography, optim_homography = self.e2e.optim(goal_image[None], self.template_image,
+                                                               upstream_homography=initial_guess)
+        return optim_homography
+
+    def estimate_batch(self, frames: list, initial_guesses: torch.Tensor = None) -> torch.Tensor:
+        """
+        Calcola le omografie ottimizzate di piu' frame insieme: ad ogni
+        iterazione un solo forward/backward sull'intero batch, con parametri
+        e miglior iterazione separati per ciascun frame.
+        Ritorna un tensore (B, 3, 3).
+        """
+        goal_images = torch.stack([prepareGoalImage(frame, self.opt) for frame in frames])
+        with profiling.stage('homography'):
+            orig_homography, optim_homography = self.e2e.optim(goal_images, self.template_image,
+                                                               upstream_homography=initial_guesses)
+        return optim_homography
+
+    def initial_guess_batch(self, frames: list) -> torch.Tensor:
+        """
+        Omografie iniziali di piu' frame con una sola inferenza della rete di
+        init guess (pesi originali). Ritorna un tensore (B, 3, 3).
+        """
+        goal_images = torch.stack([prepareGoalImage(frame, self.opt) for frame in frames])
+        inference = self.e2e.homography_inference
+        # Con STN l'ottimizzazione precedente modifica i pesi della rete
+        inference.refresh()
+        with torch.no_grad(), profiling.stage('homography_init_guess'):
+            return inference.infer_upstream_homography(goal_images)
+
+    def cache_options(self) -> dict:
+        """Opzioni che influenzano il risultato, da usare nella chiave della cache."""
+        return cacheOptions(self.opt)
+
+    def reset_tracking(self):
+        """Dimentica il frame precedente: la prossima stima parte da zero."""
+        self.e2e.reset_tracking()
+
+    @property
+    def tracking_stats(self) -> dict:
+        """Numero di frame stimati a caldo, a freddo e ripartiti a freddo."""
+        return dict(self.e2e.tracking_stats)
+
+    @property
+    def optim_stats(self) -> dict:
+        """Iterazioni usate dall'ultima stima e motivo dell'arresto."""
+        return dict(self.e2e.optim_stats)
+
+
+_default_estimator = None
+
+
+def getDefaultEstimator() -> HomographyEstimator:
+    """Ritorna lo stimatore condiviso, creandolo al primo utilizzo."""
+    global _default_estimator
+    if _default_estimator is None:
+        _default_estimator = HomographyEstimator()
+    return _default_estimator
+
+
+def calculateOptimHomography(frame: Frame) -> torch.Tensor:
+    """
+    Calcola la matrice di omografia ottimale per un'immagine di campo da calcio.
+    
+    Args:
+        frame (Frame): Frame del campo (o percorso dell'immagine)
+        
+    Returns:
+        torch.Tensor: Matrice di omografia ottimizzata
+    """
+    if isinstance(frame, str):
+        frame = Frame.from_path(frame)
+
+    # Esegue l'ottimizzazione end-to-end con i modelli gia' caricati
+    optim_homography = getDefaultEstimator().estimate(frame)
     
     print("Omografia calcolata con successo!")
     return optim_homography
 
-def save_homography(homography: torch.Tensor, save_path: str):
-    """Salva la matrice di omografia su disco."""
-    torch.save(homography, save_path)
-    print(f"Omografia salvata in: {save_path}")
+def calculateOptimHomographyBatch(frames: list, batch_size: int = 8) -> list[torch.Tensor]:
+    """
+    Calcola le omografie ottimali di piu' immagini, ottimizzandole a gruppi
+    di `batch_size` in un'unica esecuzione.
 
-def load_homography(load_path: str) -> torch.Tensor:
-    """Carica la matrice di omografia da disco."""
-    homography = torch.load(load_path)
-    print(f"Omografia caricata da: {load_path}")
-    return homography
+    Args:
+        frames (list): Frame dei campi (o percorsi delle immagini)
+        batch_size (int): Numero massimo di immagini ottimizzate insieme
+
+    Returns:
+        list[torch.Tensor]: Matrici di omografia ottimizzate (1, 3, 3), nello stesso ordine
+    """
+    frames = [Frame.from_path(frame) if isinstance(frame, str) else frame for frame in frames]
+    estimator = getDefaultEstimator()
+    homographies = []
+    for start in range(0, len(frames), batch_size):
+        optim_homography = estimator.estimate_batch(frames[start:start + batch_size])
+        homographies.extend(homography[None] for homography in optim_homography)
+    return homographies
@@ -1,24 +1,99 @@
 import cv2
-import torch
 import numpy as np
-import os
-from offside.homography import convertPoint3Dto2D, convertPoint2Dto3D
+from offside.homography import PITCH_HEIGHT, PITCH_WIDTH, PitchProjection
+from pipeline.frame import Frame
+from pipeline.artifacts import ArtifactSink
+from sportsfield_release.utils import profiling
+
+# Lunghezza reale del campo rappresentato dal template (PITCH_WIDTH pixel)
+PITCH_LENGTH_METRES = 105.0
+
+TEMPLATE_PATH = 'sportsfield_release/data/world_cup_template.png'
+OFFSIDE_TAG_PATH = 'data/offside_tag.png'
+
+# Asset del disegno gia' caricati, per (template, tag)
+_ASSETS_CACHE = {}
+
+
+def defaultOffsideTag() -> np.ndarray:
+    """Tag BGRA usato quando 'data/offside_tag.png' non esiste."""
+    offside_tag = np.zeros((60, 130, 4), dtype=np.uint8)
+    cv2.putText(offside_tag, "OFFSIDE", (10, 40), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255, 255), 2)
+    offside_tag[:, :, 3] = 255  # Canale alfa
+    return offside_tag
+
+
+class OverlayTag:
+    """
+    Immagine da sovrapporre con l'alfa gia' preparato in interi a 16 bit:
+    `inverse_alpha` = 255 - alfa e `premultiplied` = colore * alfa, cosi' la
+    composizione di un pixel e' (sfondo * inverse_alpha + premultiplied) / 255.
+    """
+
+    def __init__(self, tag: np.ndarray):
+        if tag.ndim == 2:
+            tag = cv2.cvtColor(tag, cv2.COLOR_GRAY2BGR)
+        self.height, self.width = tag.shape[:2]
+        if tag.shape[2] == 4:
+            alpha = tag[:, :, 3:].astype(np.uint16)
+        else:
+            alpha = np.full((self.height, self.width, 1), 255, dtype=np.uint16)
+        self.inverse_alpha = 255 - alpha
+        self.premultiplied = tag[:, :, :3].astype(np.uint16) * alpha
+
+
+class OverlayAssets:
+    """Template del campo 2D e tag del fuorigioco, letti da disco una sola volta."""
+
+    def __init__(self, template_path: str = TEMPLATE_PATH, tag_path: str = OFFSIDE_TAG_PATH):
+        self.template = cv2.imread(template_path)
+        if self.template is None:
+            raise FileNotFoundError(f"Template del campo non trovato: {template_path}")
+        # cv2.imread non solleva eccezioni: None se il file manca o non e' leggibile
+        offside_tag = cv2.imread(tag_path, cv2.IMREAD_UNCHANGED)
+        self.offside_tag = OverlayTag(offside_tag if offside_tag is not None else defaultOffsideTag())
+
+    def pitch(self) -> np.ndarray:
+        """Copia del template su cui disegnare la mappa 2D."""
+        return self.template.copy()
+
+
+def getOverlayAssets(template_path: str = TEMPLATE_PATH, tag_path: str = OFFSIDE_TAG_PATH) -> OverlayAssets:
+    key = (template_path, tag_path)
+    assets = _ASSETS_CACHE.get(key)
+    if assets is None:
+        assets = OverlayAssets(template_path, tag_path)
+        _ASSETS_CACHE[key] = assets
+    return assets
+
+
+def compositeTags(image: np.ndarray, tag: OverlayTag, positions) -> np.ndarray:
+    """
+    Sovrappone (in place) lo stesso tag in piu' posizioni [x, y] (angolo in alto
+    a sinistra), nell'ordine dato. Le parti fuori dall'immagine vengono
+    tagliate, anche se il tag e' solo in parte visibile.
+    """
+    h_img, w_img = image.shape[:2]
+    for x, y in positions:
+        x, y = int(x), int(y)
+        # Intersezione tra il tag e l'immagine
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + tag.width, w_img), min(y + tag.height, h_img)
+        if x0 >= x1 or y0 >= y1:
+            continue
+        roi = image[y0:y1, x0:x1]
+        tag_rows, tag_cols = slice(y0 - y, y1 - y), slice(x0 - x, x1 - x)
+        blended = roi * tag.inverse_alpha[tag_rows, tag_cols] + tag.premultiplied[tag_rows, tag_cols]
+        roi[...] = (blended + 127) // 255
+    return image
+
 
 def putPng(image, tag, position) -> None:
     """Sovrappone un'immagine PNG con trasparenza su un'altra immagine."""
-    if tag.shape[2] == 4:
-        b, g, r, a = cv2.split(tag)
-        maschera = cv2.merge([a, a, a])
-        maschera_inversa = cv2.bitwise_not(maschera)
-        
-        altezza_sovrapposta, larghezza_sovrapposta = tag.shape[:2]
-        x, y = position[0], position[1]
-        
-        roi = image[y:y+altezza_sovrapposta, x:x+larghezza_sovrapposta]
-        sfondo_bg = cv2.bitwise_and(roi, roi, mask=maschera_inversa[:, :, 0])
-        sovrapposta_fg = cv2.bitwise_and(tag[:, :, :3], tag[:, :, :3], mask=maschera[:, :, 0])
-        combinata = cv2.add(sfondo_bg, sovrapposta_fg)
-        image[y:y+altezza_sovrapposta, x:x+larghezza_sovrapposta] = combinata
+    if not isinstance(tag, OverlayTag):
+        tag = OverlayTag(tag)
+    compositeTags(image, tag, [position])
+
 
 def extend_line_to_image_borders(p1, p2, image_shape):
     h_img, w_img = image_shape[:2]
@@ -46,40 +121,124 @@ def extend_line_to_image_borders(p1, p2, image_shape):
     return point_left, point_right
 
 
-def drawOffside(pathImage: str, team: str, colors: dict, homography: torch.Tensor, 
-                defender: list, attacker: list, goalkeeper: list = None) -> int:
+class OffsideResult:
     """
-    Calcola e disegna il fuorigioco su immagine 2D e 3D.
-    
+    Esito della decisione di fuorigioco, indipendente dal disegno.
+
+    Attributes:
+        side: Meta' campo difesa ('left' o 'right')
+        last_defender_x: Ascissa dell'ultimo difensore sul campo 2D (pixel del
+            template, 1 pixel = 10 cm), None se non ci sono difensori
+        offside_indices: Indici (in `attacker`) degli attaccanti in fuorigioco
+        line: Estremi (p1, p2) della linea del fuorigioco nell'immagine 3D,
+            estesa ai bordi; None se non ci sono difensori
+        attacker2D, defender2D: Posizioni dei giocatori sul campo 2D (N, 2)
+        goalkeeper2D: Posizione del portiere sul campo 2D, se presente
+    """
+
+    def __init__(self, side: str, last_defender_x, offside_indices: list, line,
+                 attacker2D: np.ndarray, defender2D: np.ndarray, goalkeeper2D=None):
+        self.side = side
+        self.last_defender_x = last_defender_x
+        self.offside_indices = offside_indices
+        self.line = line
+        self.attacker2D = attacker2D
+        self.defender2D = defender2D
+        self.goalkeeper2D = goalkeeper2D
+
+    @property
+    def offside_count(self) -> int:
+        return len(self.offside_indices)
+
+    @property
+    def last_defender_metres(self):
+        """Ascissa dell'ultimo difensore in metri dalla linea di porta sinistra."""
+        if self.last_defender_x is None:
+            return None
+        return self.last_defender_x * PITCH_LENGTH_METRES / PITCH_WIDTH
+
+    def to_dict(self) -> dict:
+        """Rappresentazione serializzabile in JSON."""
+        return {
+            'side': self.side,
+            'last_defender_x': None if self.last_defender_x is None else float(self.last_defender_x),
+            'last_defender_metres': self.last_defender_metres,
+            'offside_count': self.offside_count,
+            'offside_indices': list(self.offside_indices),
+            'line': None if self.line is None else [[int(c) for c in p] for p in self.line],
+        }
+
+
+def feetPositions(boxes: list) -> list:
+    """Punto a terra dei box [x1, y1, x2, y2]: centro del lato inferiore."""
+    return [[round((abs(p[0] + p[2]) / 2)), p[3]] for p in boxes]
+
+
+@profiling.timed('detect_offside')
+def detectOffside(size: tuple, homography, defender: list, attacker: list,
+                  goalkeeper: list = None) -> OffsideResult:
+    """
+    Decide il fuorigioco senza leggere ne' disegnare immagini.
+
     Args:
-        pathImage: Path dell'immagine 3D
-        team: Squadra che attacca ('Team A' o 'Team B')
-        colors: Dizionario colori squadre
-        homography: Matrice omografia
-        defender: Lista posizioni difensori
-        attacker: Lista posizioni attaccanti
-        goalkeeper: Lista posizioni portiere
-    
+        size: Dimensioni (larghezza, altezza) dell'immagine 3D
+        homography: Matrice omografia (array NumPy 3x3 o tensore torch)
+        defender: Lista box difensori
+        attacker: Lista box attaccanti
+        goalkeeper: Lista box portiere
+
     Returns:
-        int: Numero attaccanti in fuorigioco
+        OffsideResult: lato, ultimo difensore, attaccanti in fuorigioco e linea
     """
-    image = cv2.imread(pathImage)
-    pitch2D = cv2.imread("sportsfield_release/data/world_cup_template.png")
-    
-    # Carica tag fuorigioco (crea un'immagine di default se non esiste)
-    try:
-        offside_tag = cv2.imread('data/offside_tag.png', cv2.IMREAD_UNCHANGED)
-    except:
-        # Crea tag temporaneo se non esiste
-        offside_tag = np.zeros((60, 130, 4), dtype=np.uint8)
-        cv2.putText(offside_tag, "OFFSIDE", (10, 40), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255, 255), 2)
-        offside_tag[:, :, 3] = 255  # Canale alfa
-    
-    w, h = len(image[0]), len(image)
-    offside = []
-    attacker2D = []
-    defender2D = []
-    
+    w, h = size
+    # Matrice pixel -> campo composta una volta, inversa calcolata solo se serve
+    projection = PitchProjection(homography, w, h)
+    attacker2D = projection.toPitch(feetPositions(attacker))
+    defender2D = projection.toPitch(feetPositions(defender))
+
+    # Determina lato di gioco
+    goalkeeper2D = None
+    if goalkeeper and len(goalkeeper) > 0:
+        goalkeeper2D = projection.toPitch(feetPositions(goalkeeper[:1]))[0]
+        side = 'left' if goalkeeper2D[0] < PITCH_WIDTH / 2 else 'right'
+    else:
+        # Determina lato basandosi sulla distribuzione giocatori
+        xs = np.concatenate([defender2D[:, 0], attacker2D[:, 0]])
+        c_left = int(np.count_nonzero(xs < PITCH_WIDTH / 2))
+        side = 'left' if c_left > len(xs) - c_left else 'right'
+
+    if len(defender2D) == 0:
+        return OffsideResult(side, None, [], None, attacker2D, defender2D, goalkeeper2D)
+
+    # Linea del fuorigioco: ultimo difensore verso la propria porta
+    if side == 'left':
+        last_def_x = float(defender2D[:, 0].min())
+        offside = attacker2D[:, 0] < last_def_x
+    else:
+        last_def_x = float(defender2D[:, 0].max())
+        offside = attacker2D[:, 0] > last_def_x
+
+    p1, p2 = projection.toImage([[last_def_x, 0], [last_def_x, PITCH_HEIGHT]])
+    line = extend_line_to_image_borders(p1, p2, (h, w))
+    return OffsideResult(side, last_def_x, np.flatnonzero(offside).tolist(), line,
+                         attacker2D, defender2D, goalkeeper2D)
+
+
+@profiling.timed('render_offside')
+def renderOffside(image: np.ndarray, result: OffsideResult, team: str, colors: dict,
+                  attacker: list, assets: OverlayAssets = None) -> tuple:
+    """
+    Disegna l'esito di `detectOffside`: linea e tag sull'immagine 3D (in place)
+    e mappa 2D dei giocatori sul template del campo. Gli asset (template e tag)
+    sono quelli in cache di `getOverlayAssets` se non indicati.
+
+    Returns:
+        tuple: (immagine 3D annotata, mappa 2D)
+    """
+    if assets is None:
+        assets = getOverlayAssets()
+    pitch2D = assets.pitch()
+
     # Determina colori squadre
     if team == 'Team A':
         c_def = colors.get('Team B', np.array([255, 0, 0])).tolist()
@@ -87,82 +246,90 @@ def drawOffside(pathImage: str, team: str, colors: dict, homography: torch.Tenso
     else:
         c_def = colors.get('Team A', np.array([0, 0, 255])).tolist()
         c_att = colors.get('Team B', np.array([255, 0, 0])).tolist()
-    
-    # Converte posizioni a 2D
-    for p in attacker:
-        x_center = round((abs(p[0] + p[2]) / 2))
-        p_att = convertPoint3Dto2D(homography, [x_center, p[3]], w, h)
-        attacker2D.append(p_att)
-        
-    for p in defender:
-        x_center = round((abs(p[0] + p[2]) / 2))
-        p_def = convertPoint3Dto2D(homography, [x_center, p[3]], w, h)
-        defender2D.append(p_def)
-    
-    # Determina lato di gioco
-    side = 'left'
-    if goalkeeper and len(goalkeeper) > 0:
-        x_center = round((abs(goalkeeper[0][0] + goalkeeper[0][2]) / 2))
-        p_gk = convertPoint3Dto2D(homography, [x_center, goalkeeper[0][3]], w, h)
-        side = 'left' if p_gk[0] < 525 else 'right'  # 525 = 1050/2
+
+    if result.goalkeeper2D is not None:
+        p_gk = result.goalkeeper2D
         cv2.circle(pitch2D, (int(p_gk[0]), int(p_gk[1])), 10, c_def, -1)
-    else:
-        # Determina lato basandosi sulla distribuzione giocatori
-        c_left = sum(1 for p in defender2D + attacker2D if p[0] < 525)
-        c_right = len(defender2D + attacker2D) - c_left
-        side = 'left' if c_left > c_right else 'right'
-    
-    # Calcola linea fuorigioco e rileva infrazioni
-    if side == 'left':
-        last_def = min(defender2D, key=lambda x: x[0])
-        cv2.line(pitch2D, (int(last_def[0]), 0), (int(last_def[0]), 680), (0, 255, 255), 2)
-        
+
+    if result.line is not None:
+        last_def_x = int(result.last_defender_x)
+        cv2.line(pitch2D, (last_def_x, 0), (last_def_x, PITCH_HEIGHT), (0, 255, 255), 2)
         # Disegna linea su immagine 3D
-        invex_homo = torch.inverse(homography)
-        p1 = convertPoint2Dto3D(invex_homo, [last_def[0], 0], w, h)
-        p2 = convertPoint2Dto3D(invex_homo, [last_def[0], 680], w, h)
-        p1_ext, p2_ext = extend_line_to_image_borders(p1, p2, image.shape)
-        cv2.line(image, p1_ext, p2_ext, (0, 255, 255), 3)
-        #cv2.line(image, (int(p1[0]), int(p1[1])), (int(p2[0]), int(p2[1])), (0, 255, 255), 3)
-        
-        for i, p in enumerate(attacker2D):
-            if p[0] < last_def[0]:
-                offside.append(p)
-                mediax = round(((attacker[i][2] - attacker[i][0]) / 2) + attacker[i][0])
-                putPng(image, offside_tag, [mediax - 65, attacker[i][1] - 30])
-                
-    else:  # side == 'right'
-        last_def = max(defender2D, key=lambda x: x[0])
-        cv2.line(pitch2D, (int(last_def[0]), 0), (int(last_def[0]), 680), (0, 255, 255), 2)
-        
-        invex_homo = torch.inverse(homography)
-        p1 = convertPoint2Dto3D(invex_homo, [last_def[0], 0], w, h)
-        p2 = convertPoint2Dto3D(invex_homo, [last_def[0], 680], w, h)
-        p1_ext, p2_ext = extend_line_to_image_borders(p1, p2, image.shape)
-        cv2.line(image, p1_ext, p2_ext, (0, 255, 255), 3)
-        #cv2.line(image, (int(p1[0]), int(p1[1])), (int(p2[0]), int(p2[1])), (0, 255, 255), 3)
-
-        for i, p in enumerate(attacker2D):
-            if p[0] > last_def[0]:
-                offside.append(p)
-                mediax = round(((attacker[i][2] - attacker[i][0]) / 2) + attacker[i][0])
-                putPng(image, offside_tag, [mediax - 65, attacker[i][1] - 30])
-    
+        cv2.line(image, result.line[0], result.line[1], (0, 255, 255), 3)
+
+    # Tag centrati sul bordo superiore dei box, con alfa e dimensioni gia' in cache
+    offside_tag = assets.offside_tag
+    positions = []
+    for i in result.offside_indices:
+        mediax = round(((attacker[i][2] - attacker[i][0]) / 2) + attacker[i][0])
+        positions.append([mediax - offside_tag.width // 2, attacker[i][1] - offside_tag.height // 2])
+    compositeTags(image, offside_tag, positions)
+
     # Disegna giocatori su mappa 2D
-    for p in attacker2D:
-        if p in offside:
+    offside = set(result.offside_indices)
+    for i, p in enumerate(result.attacker2D):
+        if i in offside:
             cv2.circle(pitch2D, (int(p[0]), int(p[1])), 12, (0, 255, 255), -1)
         cv2.circle(pitch2D, (int(p[0]), int(p[1])), 10, c_att, -1)
-    
-    for p in defender2D:
+
+    for p in result.defender2D:
         cv2.circle(pitch2D, (int(p[0]), int(p[1])), 10, c_def, -1)
+
+    return image, pitch2D
+
+
+def evaluateOffside(frame: Frame, team: str, colors: dict, homography,
+                    defender: list, attacker: list, goalkeeper: list = None,
+                    sink: ArtifactSink = None) -> OffsideResult:
+    """
+    Decide il fuorigioco e, solo se c'e' un sink abilitato, disegna e salva le
+    immagini 'offside_3D.jpg' e 'offside_2D.png'. Senza sink (o con un NullSink)
+    non c'e' alcun I/O di immagini e il frame non viene decodificato se non serve.
+    """
+    if isinstance(frame, str):
+        frame = Frame.from_path(frame)
+    result = detectOffside(frame.size, homography, defender, attacker, goalkeeper)
+
+    if sink is not None and sink.enabled:
+        # Si disegna su una copia: il frame e' condiviso con gli altri stadi
+        image, pitch2D = renderOffside(frame.bgr.copy(), result, team, colors, attacker)
+        sink.write('offside_3D.jpg', image)
+        sink.write('offside_2D.png', pitch2D)
+    return result
+
+
+def drawOffside(frame: Frame, team: str, colors: dict, homography, 
+                defender: list, attacker: list, goalkeeper: list = None, sink: ArtifactSink = None) -> int:
+    """
+    Calcola e disegna il fuorigioco su immagine 2D e 3D.
     
-    # Salva risultati
-    results_dir = "results"
-    if not os.path.exists(results_dir):
-        os.makedirs(results_dir)
+    Args:
+        frame: Frame dell'immagine 3D (o il suo percorso)
+        team: Squadra che attacca ('Team A' o 'Team B')
+        colors: Dizionario colori squadre
+        homography: Matrice omografia (array NumPy 3x3 o tensore torch)
+        defender: Lista posizioni difensori
+        attacker: Lista posizioni attaccanti
+        goalkeeper: Lista posizioni portiere
+        sink: Destinazione delle immagini 'offside_3D.jpg' e 'offside_2D.png';
+            senza sink abilitato le immagini non vengono nemmeno disegnate
     
-    cv2.imwrite(os.path.join(results_dir, 'offside_3D.jpg'), image)
-    cv2.imwrite(os.path.join(results_dir, 'offside_2D.png'), pitch2D)
+    Returns:
+        int: Numero attaccanti in fuorigioco
+    """
+    return evaluateOffside(frame, team, colors, homography, defender, attacker, goalkeeper, sink).offside_count
+
+
+def annotateOffside(image: np.ndarray, team: str, colors: dict, homography,
+                    defender: list, attacker: list, goalkeeper: list = None) -> tuple:
+    """
+    Calcola e disegna il fuorigioco su un'immagine BGR gia' decodificata,
+    senza scrivere nulla su disco.
     
-    return len(offside)
\ No newline at end of file
+    Returns:
+        tuple: (numero attaccanti in fuorigioco, immagine 3D annotata, mappa 2D)
+    """
+    h, w = image.shape[:2]
+    result = detectOffside((w, h), homography, defender, attacker, goalkeeper)
+    image, pitch2D = renderOffside(image, result, team, colors, attacker)
+    return result.offside_count, image, pitch2D
@@ -0,0 +1,126 @@
+"""
+Destinazioni per le immagini prodotte dagli stadi (artefatti).
+
+Gli stadi non scrivono piu' direttamente in `results`: ricevono un sink che
+puo' tenerle in memoria, scriverle su disco in background o scartarle.
+"""
+import abc
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from sportsfield_release.utils import profiling
+
+RESULTS_ROOT = 'results'
+
+
+def job_directory(root: str = RESULTS_ROOT, job_id: str = None) -> str:
+    """
+    Ritorna una cartella riservata a un singolo job, in modo che
+    esecuzioni parallele non si sovrascrivano i risultati.
+    """
+    if job_id is None:
+        job_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    return os.path.join(root, job_id)
+
+
+class ArtifactSink(abc.ABC):
+    """
+    Interfaccia comune dei sink.
+    `write` prende possesso dell'immagine: il chiamante non deve piu' modificarla.
+    """
+
+    enabled = True
+
+    @abc.abstractmethod
+    def write(self, name: str, image: np.ndarray):
+        pass
+
+    def flush(self) -> None:
+        """Attende che tutti gli artefatti siano disponibili."""
+
+    def close(self) -> None:
+        self.flush()
+
+
+class NullSink(ArtifactSink):
+    """Scarta tutti gli artefatti; gli stadi possono evitare di produrli."""
+
+    enabled = False
+
+    def write(self, name: str, image: np.ndarray):
+        return None
+
+
+class MemorySink(ArtifactSink):
+    """
+    Tiene gli artefatti in memoria, come array oppure gia' codificati
+    (bytes nel formato indicato dall'estensione del nome).
+    """
+
+    def __init__(self, encode: bool = False):
+        self._encode = encode
+        self._lock = threading.Lock()
+        self.artifacts = {}
+
+    def write(self, name: str, image: np.ndarray):
+        if self._encode:
+            ok, buffer = cv2.imencode(os.path.splitext(name)[1] or '.png', image)
+            if not ok:
+                raise ValueError(f"Impossibile codificare l'artefatto: {name}")
+            image = buffer.tobytes()
+        with self._lock:
+            self.artifacts[name] = image
+        return name
+
+    def get(self, name: str):
+        with self._lock:
+            return self.artifacts.get(name)
+
+
+class DiskSink(ArtifactSink):
+    """
+    Scrive gli artefatti in `directory` tramite un pool di thread in background.
+    Con `workers=0` la scrittura e' sincrona.
+    """
+
+    def __init__(self, directory: str = None, workers: int = 2):
+        self.directory = directory if directory is not None else job_directory()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='artifact-writer') \
+            if workers > 0 else None
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def write(self, name: str, image: np.ndarray):
+        path = os.path.join(self.directory, name)
+        if self._executor is None:
+            self._save(path, image)
+        else:
+            future = self._executor.submit(self._save, path, image)
+            with self._lock:
+                self._pending.append(future)
+        return path
+
+    def flush(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for future in pending:
+            # Rilancia eventuali errori di scrittura nel thread del chiamante
+            future.result()
+
+    def close(self) -> None:
+        self.flush()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    @staticmethod
+    def _save(path: str, image: np.ndarray) -> None:
+        with profiling.stage('artifact_io'):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if not cv2.imwrite(path, image):
+                raise IOError(f"Impossibile scrivere l'artefatto: {path}")
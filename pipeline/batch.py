@@ -0,0 +1,209 @@
+"""
+Elaborazione headless di un archivio di immagini su piu' processi.
+
+Le immagini (una cartella o un glob) vengono distribuite su N processi worker;
+ogni worker carica YOLO e i modelli End2EndOptim una sola volta.
+I risultati vengono scritti in JSON Lines, un record per immagine, e
+un'esecuzione interrotta riprende saltando le immagini gia' elaborate.
+
+Uso:
+    python -m pipeline.batch "archivio/*.jpg" --workers 4 --threads 2
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import time
+
+import cv2
+import torch
+
+from detection.yolo_detector import DetectorSession
+from color_clustering.clustering import team_classification_complete
+from analysis.attack_prediction import predictTeamAttacking, assignTeamNames
+from offside.homography import asHomographyArray
+from offside.homography_calculator import HomographyEstimator
+from offside.homography_cache import HomographyCache
+from offside.offside_detection import evaluateOffside
+from pipeline.frame import Frame
+from sportsfield_release.utils import profiling
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+# Stato del processo worker, inizializzato da _init_worker
+_worker = None
+
+
+def list_images(source: str) -> list[str]:
+    """Ritorna le immagini di una cartella o di un glob, in ordine."""
+    if os.path.isdir(source):
+        paths = [os.path.join(source, name) for name in os.listdir(source)]
+    else:
+        paths = glob.glob(source, recursive=True)
+    return sorted(path for path in paths if path.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def load_completed(output_path: str) -> set[str]:
+    """Immagini gia' elaborate con successo in un'esecuzione precedente."""
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Ultima riga troncata da un'interruzione
+                continue
+            if 'error' not in record:
+                completed.add(record['image'])
+    return completed
+
+
+def set_thread_count(threads: int) -> None:
+    """Limita i thread di PyTorch e OpenCV per non sovraccaricare i core."""
+    torch.set_num_threads(threads)
+    cv2.setNumThreads(threads)
+
+
+class BatchWorker:
+    """
+    Modelli di un processo worker, caricati una sola volta:
+    detector YOLO, stimatore dell'omografia e cache delle omografie.
+    """
+
+    def __init__(self):
+        self.detector = DetectorSession()
+        self.detector.warm_up()
+        self.estimator = HomographyEstimator()
+        self.cache = HomographyCache()
+
+    def analyze(self, path: str) -> dict:
+        frame = Frame.from_path(path)
+        boxes, classes = self.detector.detect(frame)
+        players, colors = team_classification_complete(boxes, classes, frame)
+        percent_team_1, percent_team_2 = predictTeamAttacking(players, frame.bgr)
+        attacking = assignTeamNames(players, percent_team_1, percent_team_2)
+        defending = 'Team B' if attacking == 'Team A' else 'Team A'
+        # assignTeamNames chiama 'Team A' la squadra 0 solo se attacca di piu'
+        names = {0: 'Team A', 1: 'Team B'} if percent_team_1 > percent_team_2 else {0: 'Team B', 1: 'Team A'}
+
+        key = self.cache.make_key(frame.bgr, self.estimator.cache_options())
+        homography = self.cache.get(key)
+        optim_iterations = 0
+        if homography is None:
+            homography = self.estimator.estimate(frame)
+            optim_iterations = self.estimator.optim_stats['iterations']
+            self.cache.put(key, homography)
+
+        # Solo la decisione: senza sink nessuna immagine viene disegnata o scritta
+        offside = None
+        if players.get(defending):
+            offside = evaluateOffside(frame, attacking, colors, homography, players[defending],
+                                      players.get(attacking, []), players.get('goalkeeper', [])).to_dict()
+
+        return {
+            'teams': {name: len(team_boxes) for name, team_boxes in players.items()},
+            'team_colors': {names[index]: [int(c) for c in color] for index, color in colors.items()},
+            'attack_percentages': {names[0]: float(percent_team_1), names[1]: float(percent_team_2)},
+            'attacking_team': attacking,
+            'offside_count': offside['offside_count'] if offside else 0,
+            'offside': offside,
+            'homography': asHomographyArray(homography).tolist(),
+            'optim_iterations': optim_iterations,
+        }
+
+
+def _init_worker(threads: int, profile: bool = False) -> None:
+    global _worker
+    set_thread_count(threads)
+    if profile:
+        profiling.enable()
+    _worker = BatchWorker()
+    # Il caricamento dei modelli non fa parte dei tempi per immagine
+    profiling.reset()
+
+
+def _process_image(path: str) -> dict:
+    start = time.perf_counter()
+    record = {'image': path}
+    try:
+        record.update(_worker.analyze(path))
+    except Exception as e:
+        record['error'] = f'{type(e).__name__}: {e}'
+    record['seconds'] = time.perf_counter() - start
+    record['worker'] = os.getpid()
+    if profiling.is_enabled():
+        record['stages'] = profiling.take_totals()
+    return record
+
+
+def run(source: str, output_path: str, workers: int, threads: int, resume: bool = True,
+        profile: bool = False) -> dict:
+    """
+    Elabora tutte le immagini di `source` e accoda i risultati a `output_path`.
+    Con `profile` ogni record contiene i tempi (wall, cpu) per stadio, aggregati
+    anche nel processo principale (vedi `profiling.summary`).
+    Ritorna statistiche sull'esecuzione.
+    """
+    paths = list_images(source)
+    completed = load_completed(output_path) if resume else set()
+    pending = [path for path in paths if path not in completed]
+    print(f"Immagini: {len(paths)}, gia' elaborate: {len(paths) - len(pending)}, da elaborare: {len(pending)}")
+
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    processed, errors = 0, 0
+    start = time.perf_counter()
+    if pending:
+        # 'spawn': ogni worker parte da un processo pulito (PyTorch e fork non vanno d'accordo)
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(processes=workers, initializer=_init_worker, initargs=(threads, profile)) as pool, \
+                open(output_path, 'a' if resume else 'w') as out:
+            for record in pool.imap_unordered(_process_image, pending):
+                for name, (wall, cpu) in record.get('stages', {}).items():
+                    profiling.record(name, wall, cpu)
+                out.write(json.dumps(record) + '\n')
+                # Ogni record e' subito su disco: un'interruzione non perde il lavoro fatto
+                out.flush()
+                processed += 1
+                errors += 'error' in record
+                if 'error' in record:
+                    print(f"{record['image']}: {record['error']}")
+    elapsed = time.perf_counter() - start
+
+    stats = {
+        'images': len(paths),
+        'skipped': len(paths) - len(pending),
+        'processed': processed,
+        'errors': errors,
+        'seconds': elapsed,
+        'images_per_second': processed / elapsed if elapsed > 0 else 0.0,
+    }
+    print(f"Elaborate {processed} immagini in {elapsed:.2f}s "
+          f"({stats['images_per_second']:.2f} img/s), errori: {errors}")
+    return stats
+
+
+def main():
+    cpu_count = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description='Rilevamento del fuorigioco su un archivio di immagini.')
+    parser.add_argument('source', help='cartella o glob delle immagini (es. "archivio/**/*.jpg")')
+    parser.add_argument('--output', default=os.path.join('results', 'batch.jsonl'), help='file JSON Lines dei risultati')
+    parser.add_argument('--workers', type=int, default=max(1, cpu_count // 2), help='numero di processi worker')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='thread per worker (default: core disponibili / worker)')
+    parser.add_argument('--no-resume', action='store_true', help='ricomincia da zero sovrascrivendo l\'output')
+    parser.add_argument('--profile', default=None,
+                        help='file JSON in cui salvare le latenze per stadio (p50/p95/p99)')
+    args = parser.parse_args()
+
+    threads = args.threads if args.threads is not None else max(1, cpu_count // args.workers)
+    run(args.source, args.output, args.workers, threads, resume=not args.no_resume, profile=bool(args.profile))
+    if args.profile:
+        profiling.print_summary()
+        profiling.export_json(args.profile)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+Frame condiviso da tutti gli stadi della pipeline.
+
+Il frame viene decodificato una sola volta; le viste derivate (RGB, HSV,
+versioni a bassa risoluzione, tensori per le reti) vengono calcolate solo
+quando servono e poi memorizzate.
+"""
+import io
+import os
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from sportsfield_release.utils import profiling
+
+# Fattori di riduzione supportati da cv2.imdecode
+_REDUCED_FLAGS = [(8, cv2.IMREAD_REDUCED_COLOR_8),
+                  (4, cv2.IMREAD_REDUCED_COLOR_4),
+                  (2, cv2.IMREAD_REDUCED_COLOR_2)]
+
+# Tag EXIF dell'orientamento; 5-8 ruotano di 90 gradi (larghezza e altezza scambiate)
+_EXIF_ORIENTATION = 0x0112
+_TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+def _encoded_size(encoded: bytes) -> tuple[int, int]:
+    """
+    Dimensioni (larghezza, altezza) lette dall'intestazione, con l'orientamento
+    EXIF applicato come fa cv2.imdecode.
+    """
+    image = Image.open(io.BytesIO(encoded))
+    width, height = image.size
+    if image.getexif().get(_EXIF_ORIENTATION, 1) in _TRANSPOSED_ORIENTATIONS:
+        width, height = height, width
+    return width, height
+
+
+class Frame:
+    """
+    Immagine decodificata (BGR) con viste derivate memorizzate.
+
+    Se il frame nasce da dati codificati (file o bytes), la decodifica a
+    piena risoluzione avviene solo al primo accesso a `bgr`; chi ha bisogno
+    soltanto di una vista piccola usa `resized`, che decodifica a
+    risoluzione ridotta quando possibile.
+    """
+
+    def __init__(self, bgr: np.ndarray = None, encoded: bytes = None, name: str = None):
+        if bgr is None and encoded is None:
+            raise ValueError("Serve un'immagine decodificata o i suoi bytes codificati.")
+        self._bgr = bgr
+        self._encoded = encoded
+        self._views = {}
+        self.name = name
+
+    @classmethod
+    def from_path(cls, path: str) -> 'Frame':
+        with open(path, 'rb') as f:
+            return cls(encoded=f.read(), name=path)
+
+    @classmethod
+    def from_bytes(cls, data: bytes, name: str = None) -> 'Frame':
+        return cls(encoded=data, name=name)
+
+    @classmethod
+    def from_array(cls, bgr: np.ndarray, name: str = None) -> 'Frame':
+        return cls(bgr=bgr, name=name)
+
+    @property
+    def basename(self) -> str:
+        return os.path.basename(self.name) if self.name else ''
+
+    @property
+    def bgr(self) -> np.ndarray:
+        """Immagine a piena risoluzione in BGR (formato OpenCV)."""
+        if self._bgr is None:
+            with profiling.stage('decode'):
+                image = cv2.imdecode(np.frombuffer(self._encoded, np.uint8), cv2.IMREAD_COLOR)
+            if image is None:
+                raise ValueError(f"Impossibile decodificare l'immagine: {self.name}")
+            self._bgr = image
+        return self._bgr
+
+    @property
+    def size(self) -> tuple[int, int]:
+        """
+        Dimensioni (larghezza, altezza) senza decodificare l'immagine, uguali a
+        quelle di `bgr` (orientamento EXIF compreso).
+        """
+        if self._bgr is not None:
+            return self._bgr.shape[1], self._bgr.shape[0]
+        return self.view('size', lambda frame: _encoded_size(frame._encoded))
+
+    @property
+    def shape(self) -> tuple:
+        width, height = self.size
+        return height, width, 3
+
+    @property
+    def rgb(self) -> np.ndarray:
+        return self.view('rgb', lambda frame: cv2.cvtColor(frame.bgr, cv2.COLOR_BGR2RGB))
+
+    @property
+    def hsv(self) -> np.ndarray:
+        return self.view('hsv', lambda frame: cv2.cvtColor(frame.bgr, cv2.COLOR_BGR2HSV))
+
+    def resized(self, width: int, height: int, interpolation: int = cv2.INTER_NEAREST) -> np.ndarray:
+        """
+        Vista BGR ridimensionata a (width, height).
+        Per i frame nati da dati codificati si usa sempre la decodifica ridotta
+        di OpenCV (1/2, 1/4, 1/8) col fattore piu' grande che non scende sotto la
+        dimensione richiesta, anche se `bgr` e' gia' stato decodificato: il
+        risultato non dipende da quale stadio ha usato il frame per primo.
+        """
+        def compute(frame):
+            source = None
+            if frame._encoded is not None:
+                full_width, full_height = frame.size
+                for factor, flag in _REDUCED_FLAGS:
+                    if full_width // factor >= width and full_height // factor >= height:
+                        with profiling.stage('decode_reduced'):
+                            source = cv2.imdecode(np.frombuffer(frame._encoded, np.uint8), flag)
+                        break
+            if source is None:
+                source = frame.bgr
+            return cv2.resize(source, (width, height), interpolation=interpolation)
+
+        return self.view(('resized', width, height, interpolation), compute)
+
+    def view(self, key, compute):
+        """
+        Ritorna la vista `key`, calcolandola con `compute(frame)` al primo accesso.
+        Gli stadi possono usarla per memorizzare le proprie viste (es. tensori).
+        """
+        if key not in self._views:
+            self._views[key] = compute(self)
+        return self._views[key]
@@ -0,0 +1,413 @@
+"""
+Servizio HTTP locale (solo loopback) per l'analisi delle immagini.
+
+Permette di usare la pipeline da altri strumenti, senza la GUI Tk.
+Le richieste concorrenti vengono raggruppate in micro-batch sia per la
+detection YOLO sia per l'omografia iniziale (rete di init guess): ogni batch
+parte quando raggiunge `max_batch_size` elementi oppure dopo `max_wait` secondi
+dal primo elemento.
+Solo le sezioni CPU (decodifica, classificazione, cache, fuorigioco) sono
+limitate a `max_concurrency`: le richieste arrivano ai micro-batcher senza
+limiti, cosi' un batch si puo' riempire fino a `max_batch_size`. Oltre
+`max_pending` richieste in corso il servizio risponde 503 (con Retry-After)
+invece di accodare.
+
+Endpoint:
+    POST /analyze[?render=1&attacking=Team%20A]   corpo: bytes dell'immagine
+    GET  /health
+    GET  /metrics
+
+Uso:
+    python -m pipeline.service --port 8765
+    curl --data-binary @data/test5.png "http://127.0.0.1:8765/analyze?render=1"
+"""
+import argparse
+import asyncio
+import base64
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+
+from detection.yolo_detector import DetectorSession
+from color_clustering.clustering import team_classification_complete
+from analysis.attack_prediction import predictTeamAttacking, assignTeamNames
+from visualization.visualize import draw_boxes
+from offside.homography import asHomographyArray
+from offside.homography_calculator import HomographyEstimator
+from offside.homography_cache import HomographyCache
+from offside.offside_detection import evaluateOffside, getOverlayAssets
+from pipeline.artifacts import MemorySink
+from pipeline.frame import Frame
+from sportsfield_release.utils import profiling
+
+HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+            413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class MicroBatcher:
+    """
+    Raggruppa le chiamate concorrenti a `process(items) -> results` in batch.
+    `process` gira nell'executor indicato (un solo thread se il modello
+    non e' thread-safe); ogni chiamante riceve il proprio risultato.
+    """
+
+    def __init__(self, name: str, process, executor, max_batch_size: int = 8, max_wait: float = 0.01):
+        self.name = name
+        self._process = process
+        self._executor = executor
+        self._max_batch_size = max(1, max_batch_size)
+        self._max_wait = max_wait
+        self._queue = asyncio.Queue()
+        self._task = None
+        self.batches = 0
+        self.items = 0
+
+    def start(self) -> None:
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    @property
+    def queued(self) -> int:
+        return self._queue.qsize()
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self._max_wait
+            while len(batch) < self._max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Le richieste gia' abbandonate (es. connessione chiusa) non entrano nel batch
+            batch = [(item, future) for item, future in batch if not future.done()]
+            if not batch:
+                continue
+            self.batches += 1
+            self.items += len(batch)
+            try:
+                results = await loop.run_in_executor(self._executor, self._process, [item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            'batches': self.batches,
+            'items': self.items,
+            'mean_batch_size': self.items / self.batches if self.batches else 0.0,
+            'queued': self.queued,
+        }
+
+
+class AnalysisService:
+    """
+    Modelli e stato del servizio: detector YOLO, stimatore e cache delle
+    omografie, micro-batcher e limiti di concorrenza.
+    """
+
+    def __init__(self, max_batch_size: int = 8, max_wait: float = 0.01, max_concurrency: int = 4,
+                 max_pending: int = 32, max_body_bytes: int = 20 * 2 ** 20):
+        self.detector = DetectorSession(max_batch_size=max_batch_size)
+        self.estimator = HomographyEstimator()
+        self.cache = HomographyCache()
+        # I modelli non sono thread-safe: un thread dedicato per YOLO e uno per l'omografia
+        self._detection_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='detection')
+        self._homography_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='homography')
+        self._cpu_executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='analysis')
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait
+        self._max_concurrency = max_concurrency
+        self._max_pending = max_pending
+        self._max_body_bytes = max_body_bytes
+        self._semaphore = None
+        self._detection = None
+        self._initial_guess = None
+        self._pending = 0
+        self._in_flight = 0
+        self._started = time.time()
+        self._ready = False
+        self._counters = {'requests': 0, 'rejected': 0, 'errors': 0}
+        self._latencies = deque(maxlen=10000)
+
+    async def start(self) -> None:
+        self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        self._detection = MicroBatcher('detection', self.detector.detect_batch, self._detection_executor,
+                                       self._max_batch_size, self._max_wait)
+        self._initial_guess = MicroBatcher('homography_init_guess', self.estimator.initial_guess_batch,
+                                           self._homography_executor, self._max_batch_size, self._max_wait)
+        self._detection.start()
+        self._initial_guess.start()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._detection_executor, self.detector.warm_up)
+        # Template e tag del fuorigioco letti una volta, non alla prima richiesta con immagini
+        await loop.run_in_executor(self._cpu_executor, getOverlayAssets)
+        self._ready = True
+
+    async def stop(self) -> None:
+        await self._detection.stop()
+        await self._initial_guess.stop()
+        # Ultimi usi delle omografie servite dalla memoria, per l'ordine di scarto dopo il riavvio
+        self.cache.flush()
+        for executor in (self._detection_executor, self._homography_executor, self._cpu_executor):
+            executor.shutdown(wait=False)
+
+    async def analyze(self, body: bytes, render: bool = False, attacking: str = None) -> dict:
+        """
+        Analizza un'immagine: classificazione, percentuali di attacco,
+        omografia e fuorigioco. Con `render` include le immagini annotate (base64).
+        """
+        if self._pending >= self._max_pending:
+            self._counters['rejected'] += 1
+            raise HttpError(503, 'Servizio sovraccarico, riprovare piu\' tardi.')
+        self._pending += 1
+        start = time.perf_counter()
+        try:
+            result = await self._analyze(body, render, attacking)
+        finally:
+            self._pending -= 1
+        self._latencies.append(time.perf_counter() - start)
+        return result
+
+    async def _run_cpu(self, fn, *args):
+        """
+        Esegue `fn` nell'executor CPU; il semaforo limita solo queste sezioni,
+        non l'attesa nei micro-batcher.
+        """
+        async with self._semaphore:
+            self._in_flight += 1
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self._cpu_executor, fn, *args)
+            finally:
+                self._in_flight -= 1
+
+    async def _analyze(self, body: bytes, render: bool, attacking: str) -> dict:
+        loop = asyncio.get_running_loop()
+        frame = Frame.from_bytes(body, 'upload')
+        try:
+            await self._run_cpu(lambda: frame.bgr)
+        except ValueError as e:
+            raise HttpError(400, str(e))
+
+        sink = MemorySink(encode=True) if render else None
+        boxes, classes = await self._detection.submit(frame)
+
+        def classify():
+            players, colors = team_classification_complete(boxes, classes, frame)
+            percent_team_1, percent_team_2 = predictTeamAttacking(players, frame.bgr, sink)
+            assignTeamNames(players, percent_team_1, percent_team_2)
+            if sink is not None:
+                sink.write('final_annotated_result.jpg', draw_boxes(frame.bgr, boxes, classes, players))
+            return players, colors, percent_team_1, percent_team_2
+
+        players, colors, percent_team_1, percent_team_2 = await self._run_cpu(classify)
+        # assignTeamNames chiama 'Team A' la squadra 0 solo se attacca di piu'
+        names = {0: 'Team A', 1: 'Team B'} if percent_team_1 > percent_team_2 else {0: 'Team B', 1: 'Team A'}
+        attacking = attacking if attacking in ('Team A', 'Team B') else 'Team A'
+        defending = 'Team B' if attacking == 'Team A' else 'Team A'
+
+        # Hash del frame e accesso al disco fuori dall'event loop
+        key = await self._run_cpu(self.cache.make_key, frame.bgr, self.estimator.cache_options())
+        homography = await self._run_cpu(self.cache.get, key)
+        if homography is None:
+            initial_guess = await self._initial_guess.submit(frame)
+            homography = await loop.run_in_executor(self._homography_executor, self.estimator.estimate,
+                                                    frame, initial_guess)
+            await self._run_cpu(self.cache.put, key, homography)
+
+        offside = None
+        if players.get(defending):
+            # Le immagini vengono disegnate solo se la richiesta le vuole (sink presente)
+            offside = await self._run_cpu(
+                evaluateOffside, frame, attacking, colors, homography, players[defending],
+                players.get(attacking, []), players.get('goalkeeper', []), sink)
+
+        result = {
+            'players': players,
+            'teams': {name: len(team_boxes) for name, team_boxes in players.items()},
+            'team_colors': {names[index]: [int(c) for c in color] for index, color in colors.items()},
+            'attack_percentages': {names[0]: float(percent_team_1), names[1]: float(percent_team_2)},
+            'attacking_team': attacking,
+            'defending_team': defending,
+            'offside_count': offside.offside_count if offside else 0,
+            'offside': offside.to_dict() if offside else None,
+            'homography': asHomographyArray(homography).tolist(),
+        }
+        if sink is not None:
+            result['images'] = {name: base64.b64encode(data).decode('ascii')
+                                for name, data in sink.artifacts.items()}
+        return result
+
+    def health(self) -> dict:
+        return {
+            'status': 'ok' if self._ready else 'loading',
+            'uptime_seconds': time.time() - self._started,
+        }
+
+    def metrics(self) -> dict:
+        latencies = np.array(self._latencies)
+        metrics = {
+            'counters': dict(self._counters),
+            'pending': self._pending,
+            'in_flight': self._in_flight,
+            'limits': {'max_concurrency': self._max_concurrency, 'max_pending': self._max_pending},
+            'batchers': {batcher.name: batcher.stats() for batcher in (self._detection, self._initial_guess)
+                         if batcher is not None},
+            'homography_cache': self.cache.stats,
+            'latency_ms': {
+                'count': int(latencies.size),
+                'p50': float(np.percentile(latencies, 50) * 1e3) if latencies.size else None,
+                'p95': float(np.percentile(latencies, 95) * 1e3) if latencies.size else None,
+                'p99': float(np.percentile(latencies, 99) * 1e3) if latencies.size else None,
+            },
+        }
+        if profiling.is_enabled():
+            metrics['stages'] = profiling.summary()
+        return metrics
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Gestisce una connessione HTTP/1.1 (una richiesta per connessione)."""
+        try:
+            status, payload, headers = await self._dispatch(reader)
+        except HttpError as e:
+            status, payload, headers = e.status, {'error': str(e)}, {}
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        except Exception as e:
+            self._counters['errors'] += 1
+            status, payload, headers = 500, {'error': f'{type(e).__name__}: {e}'}, {}
+        if status == 503:
+            headers['Retry-After'] = '1'
+
+        body = json.dumps(payload, default=_to_json).encode()
+        head = [f'HTTP/1.1 {status} {_REASONS.get(status, "")}',
+                'Content-Type: application/json',
+                f'Content-Length: {len(body)}',
+                'Connection: close']
+        head += [f'{name}: {value}' for name, value in headers.items()]
+        try:
+            writer.write(('\r\n'.join(head) + '\r\n\r\n').encode() + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, reader: asyncio.StreamReader):
+        request_line = (await reader.readline()).decode('latin-1').strip()
+        parts = request_line.split()
+        if len(parts) != 3:
+            raise HttpError(400, 'Richiesta HTTP non valida.')
+        method, target, _ = parts
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        url = urlsplit(target)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if url.path == '/health':
+            return 200, self.health(), {}
+        if url.path == '/metrics':
+            return 200, self.metrics(), {}
+        if url.path != '/analyze':
+            raise HttpError(404, f'Endpoint sconosciuto: {url.path}')
+        if method != 'POST':
+            raise HttpError(405, 'Usare POST con l\'immagine nel corpo della richiesta.')
+
+        self._counters['requests'] += 1
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise HttpError(400, 'Intestazione Content-Length non valida.')
+        if length <= 0:
+            raise HttpError(400, 'Corpo della richiesta vuoto.')
+        if length > self._max_body_bytes:
+            raise HttpError(413, f'Immagine troppo grande (massimo {self._max_body_bytes} bytes).')
+        body = await reader.readexactly(length)
+        render = query.get('render', '0').lower() in ('1', 'true', 'yes')
+        return 200, await self.analyze(body, render, query.get('attacking')), {}
+
+
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'Tipo non serializzabile: {type(value).__name__}')
+
+
+async def serve(service: AnalysisService, port: int = DEFAULT_PORT) -> None:
+    server = await asyncio.start_server(service.handle, HOST, port)
+    await service.start()
+    print(f'Servizio in ascolto su http://{HOST}:{port}')
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Servizio HTTP locale per il rilevamento del fuorigioco.')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='porta TCP (solo 127.0.0.1)')
+    parser.add_argument('--max-batch-size', type=int, default=8, help='elementi massimi per micro-batch')
+    parser.add_argument('--max-wait-ms', type=float, default=10.0,
+                        help='attesa massima per completare un micro-batch')
+    parser.add_argument('--max-concurrency', type=int, default=4, help='analisi eseguite contemporaneamente')
+    parser.add_argument('--max-pending', type=int, default=32,
+                        help='richieste accettate (in corso + in attesa) prima di rispondere 503')
+    parser.add_argument('--profile', action='store_true', help='espone le latenze per stadio in /metrics')
+    args = parser.parse_args()
+
+    if args.profile:
+        profiling.enable()
+    service = AnalysisService(max_batch_size=args.max_batch_size, max_wait=args.max_wait_ms / 1e3,
+                              max_concurrency=args.max_concurrency, max_pending=args.max_pending)
+    try:
+        asyncio.run(serve(service, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+"""
+Elaborazione headless di un file video.
+
+I frame vengono letti con `cv2.VideoCapture` e attraversano una pipeline a stadi:
+decode -> detection YOLO -> classificazione squadre -> predizione attacco
+-> omografia -> disegno fuorigioco -> scrittura.
+Ogni stadio gira in un proprio thread e gli stadi sono collegati da code
+limitate, cosi' decodifica, inferenza e rendering si sovrappongono
+mentre la memoria resta costante.
+
+Uso:
+    python -m pipeline.video partita.mp4 [--output out.mp4]
+"""
+import argparse
+import os
+import queue
+import threading
+import time
+
+import cv2
+
+from detection.yolo_detector import DetectorSession
+from color_clustering.clustering import team_classification_complete
+from analysis.attack_prediction import predictTeamAttacking, assignTeamNames
+from offside.homography_calculator import HomographyEstimator
+from offside.offside_detection import annotateOffside, getOverlayAssets
+from pipeline.frame import Frame
+from sportsfield_release.utils import profiling
+
+VIDEO_OUT_DIR = os.path.join('sportsfield_release', 'video_out')
+
+# Segnala la fine dello stream a tutti gli stadi successivi
+_END = object()
+
+
+class Stage(threading.Thread):
+    """
+    Stadio della pipeline: legge job dalla coda di ingresso, li elabora con
+    `work` e li inoltra alla coda di uscita.
+    Con `batch_size > 1`, `work` riceve una lista con tutti i job gia'
+    disponibili (fino a `batch_size`), senza attendere job futuri.
+    Un job fallito viene marcato con 'error' e gli stadi successivi lo saltano.
+    """
+
+    def __init__(self, name: str, work, inbox: queue.Queue, outbox: queue.Queue, batch_size: int = 1):
+        super().__init__(name=name, daemon=True)
+        self._work = work
+        self._inbox = inbox
+        self._outbox = outbox
+        self._batch_size = batch_size
+        self.busy_time = 0.0
+
+    def run(self):
+        finished = False
+        while not finished:
+            jobs = [self._inbox.get()]
+            while len(jobs) < self._batch_size and jobs[-1] is not _END:
+                try:
+                    jobs.append(self._inbox.get_nowait())
+                except queue.Empty:
+                    break
+            if jobs[-1] is _END:
+                jobs.pop()
+                finished = True
+
+            pending = [job for job in jobs if 'error' not in job]
+            if pending:
+                start = time.perf_counter()
+                self._process(pending)
+                self.busy_time += time.perf_counter() - start
+
+            for job in jobs:
+                self._outbox.put(job)
+        self._outbox.put(_END)
+
+    def _process(self, jobs: list):
+        try:
+            if self._batch_size > 1:
+                self._work(jobs)
+            else:
+                self._work(jobs[0])
+        except Exception as e:
+            for job in jobs:
+                job['error'] = f'{self.name}: {e}'
+
+
+class VideoPipeline:
+    """
+    Pipeline video a stadi con code limitate.
+    Detector e stimatore dell'omografia vengono caricati una sola volta.
+    """
+
+    def __init__(self, detector: DetectorSession = None, estimator: HomographyEstimator = None,
+                 queue_size: int = 8, detection_batch: int = 4):
+        self._detector = detector if detector is not None else DetectorSession(max_batch_size=detection_batch)
+        self._estimator = estimator if estimator is not None else HomographyEstimator(tracking=True)
+        self._queue_size = queue_size
+        self._detection_batch = detection_batch
+
+    # ------------------------------------------------------------------ stadi
+
+    def _detect(self, jobs: list):
+        detections = self._detector.detect_batch([job['frame'] for job in jobs])
+        for job, (boxes, classes) in zip(jobs, detections):
+            job['boxes'], job['classes'] = boxes, classes
+
+    def _classify(self, job: dict):
+        job['players'], job['colors'] = team_classification_complete(job['boxes'], job['classes'], job['frame'])
+
+    def _predict_attack(self, job: dict):
+        percent_team_1, percent_team_2 = predictTeamAttacking(job['players'], job['frame'].bgr)
+        job['percentages'] = (percent_team_1, percent_team_2)
+        job['attacking'] = assignTeamNames(job['players'], percent_team_1, percent_team_2)
+
+    def _homography(self, job: dict):
+        job['homography'] = self._estimator.estimate(job['frame'])
+        job['optim_iterations'] = self._estimator.optim_stats['iterations']
+
+    def _draw(self, job: dict):
+        attacking = job['attacking']
+        defending = 'Team B' if attacking == 'Team A' else 'Team A'
+        players = job['players']
+        defender_boxes = players.get(defending, [])
+        if not defender_boxes:
+            job['offside_count'] = 0
+            return
+        job['offside_count'], job['image'], _ = annotateOffside(job['image'], attacking, job['colors'],
+                                                                job['homography'], defender_boxes,
+                                                                players.get(attacking, []),
+                                                                players.get('goalkeeper', []))
+
+    # --------------------------------------------------------------- esecuzione
+
+    def _decode(self, capture: cv2.VideoCapture, outbox: queue.Queue, max_frames: int):
+        index = 0
+        while max_frames is None or index < max_frames:
+            ok, image = capture.read()
+            if not ok:
+                break
+            # 'image' e' l'immagine che verra' scritta, 'frame' la sorgente condivisa
+            outbox.put({'index': index, 'image': image, 'frame': Frame.from_array(image)})
+            index += 1
+        outbox.put(_END)
+
+    def run(self, video_path: str, output_path: str = None, max_frames: int = None) -> dict:
+        """
+        Elabora il video e scrive il risultato annotato.
+        Ritorna statistiche su frame elaborati, errori e throughput.
+        """
+        capture = cv2.VideoCapture(video_path)
+        if not capture.isOpened():
+            raise FileNotFoundError(f"Impossibile aprire il video: {video_path}")
+
+        fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+        width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+        if output_path is None:
+            name = os.path.splitext(os.path.basename(video_path))[0]
+            output_path = os.path.join(VIDEO_OUT_DIR, f'{name}_offside.mp4')
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+
+        # Warm-up fuori dal conteggio del throughput
+        self._detector.warm_up()
+        self._estimator.reset_tracking()
+        getOverlayAssets()
+
+        work = [
+            ('detection', self._detect, self._detection_batch),
+            ('classification', self._classify, 1),
+            ('attack', self._predict_attack, 1),
+            ('homography', self._homography, 1),
+            ('render', self._draw, 1),
+        ]
+        queues = [queue.Queue(maxsize=self._queue_size) for _ in range(len(work) + 1)]
+        decoder = threading.Thread(target=self._decode, args=(capture, queues[0], max_frames),
+                                   name='decode', daemon=True)
+        stages = [Stage(name, fn, queues[i], queues[i + 1], batch_size)
+                  for i, (name, fn, batch_size) in enumerate(work)]
+
+        start = time.perf_counter()
+        decoder.start()
+        for stage in stages:
+            stage.start()
+
+        frames, errors, offside_total, optim_iterations = 0, 0, 0, 0
+        while True:
+            job = queues[-1].get()
+            if job is _END:
+                break
+            if 'error' in job:
+                errors += 1
+                print(f"Frame {job['index']}: {job['error']}")
+            else:
+                offside_total += job.get('offside_count', 0)
+                optim_iterations += job.get('optim_iterations', 0)
+            writer.write(job['image'])
+            frames += 1
+        elapsed = time.perf_counter() - start
+
+        decoder.join()
+        capture.release()
+        writer.release()
+
+        stats = {
+            'frames': frames,
+            'errors': errors,
+            'offside_total': offside_total,
+            'seconds': elapsed,
+            'fps': frames / elapsed if elapsed > 0 else 0.0,
+            'stage_busy_seconds': {stage.name: stage.busy_time for stage in stages},
+            'homography_tracking': self._estimator.tracking_stats,
+            'optim_iterations_mean': optim_iterations / (frames - errors) if frames > errors else 0.0,
+            'output': output_path,
+        }
+        print(f"Elaborati {frames} frame in {elapsed:.2f}s ({stats['fps']:.2f} fps), errori: {errors}")
+        for name, busy in stats['stage_busy_seconds'].items():
+            print(f"  {name:>15}: {busy:.2f}s")
+        print(f"Omografie (tracking): {stats['homography_tracking']}, "
+              f"iterazioni medie: {stats['optim_iterations_mean']:.1f}")
+        print(f"Video annotato salvato in: {output_path}")
+        return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rilevamento del fuorigioco su un file video.')
+    parser.add_argument('video', help='percorso del video da elaborare')
+    parser.add_argument('--output', default=None,
+                        help=f'video di uscita (default: {VIDEO_OUT_DIR}/<nome>_offside.mp4)')
+    parser.add_argument('--queue-size', type=int, default=8, help='dimensione massima di ogni coda tra stadi')
+    parser.add_argument('--detection-batch', type=int, default=4, help='frame per inferenza YOLO')
+    parser.add_argument('--max-frames', type=int, default=None, help='numero massimo di frame da elaborare')
+    parser.add_argument('--time-budget', type=float, default=None,
+                        help='secondi massimi di ottimizzazione dell\'omografia per frame')
+    parser.add_argument('--patience', type=int, default=0,
+                        help='ferma l\'ottimizzazione dopo N iterazioni senza miglioramenti (0: disattivato)')
+    parser.add_argument('--profile', default=None,
+                        help='file JSON in cui salvare le latenze per stadio (p50/p95/p99)')
+    args = parser.parse_args()
+
+    if args.profile:
+        profiling.enable()
+    estimator = HomographyEstimator(tracking=True, optim_time_budget=args.time_budget,
+                                    optim_patience=args.patience)
+    pipeline = VideoPipeline(estimator=estimator, queue_size=args.queue_size,
+                             detection_batch=args.detection_batch)
+    pipeline.run(args.video, args.output, args.max_frames)
+    if args.profile:
+        profiling.print_summary()
+        profiling.export_json(args.profile)
+
+
+if __name__ == '__main__':
+    main()
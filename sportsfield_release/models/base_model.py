@@ -58,6 +58,31 @@ class BaseModel(abc.ABC):
         content_list += ['From: {0}'.format(checkpoint_path)]
         util.print_notification(content_list)
 
+    def snapshot_weights(self):
+        '''keep an in-memory copy of the current state,
+        restore_weights() goes back to it without reading the checkpoint again
+        '''
+        self._weights_snapshot = {k: v.detach().clone() for k, v in self.state_dict().items()}
+
+    def restore_weights(self):
+        '''in-place copy of the snapshot, parameters keep their identity
+        (optimizers holding them stay valid)
+        '''
+        with torch.no_grad():
+            for k, v in self.state_dict(keep_vars=True).items():
+                v.copy_(self._weights_snapshot[k])
+
+    def restore_weights_into(self, params, samples=None):
+        '''restore per-sample parameters, stacked on dim 0 and named like the model parameters
+        samples: indices of the samples to restore, all of them if None
+        '''
+        with torch.no_grad():
+            for k, v in params.items():
+                if samples is None:
+                    v.copy_(self._weights_snapshot[k].expand_as(v))
+                else:
+                    v[samples] = self._weights_snapshot[k]
+
     @abc.abstractmethod
     def _get_checkpoint_path(self):
         pass
@@ -3,16 +3,28 @@ the initial guesser + loss surface optimization
 '''
 
 import abc
+import time
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 from tqdm import tqdm
 
-from . import end_2_end_optimization_helper, loss_surface
+from . import end_2_end_optimization_helper, inference_freeze, loss_surface
+from sportsfield_release.utils import profiling
 from sportsfield_release.utils import util
 from sportsfield_release.utils import warp
 
 
+class _OptimizationStopped(Exception):
+    '''raised from the l-bfgs closure to end step() early, reason is the stop_reason
+    '''
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
 class End2EndOptimFactory(object):
     @staticmethod
     def get_end_2_end_optimization_model(opt):
@@ -37,6 +49,10 @@ class End2EndOptim(abc.ABC):
         self.build_models()
         self.build_homography_inference()
         self.lambdas = None
+        self.deadline = None
+        self.loss_hist = None
+        self.template_pyramid = None
+        self.reset_tracking()
 
     def check_options(self):
         valid_models = ['loss_surface']
@@ -47,12 +63,99 @@ class End2EndOptim(abc.ABC):
             util.print_notification(content_list, 'ERROR')
             exit(1)
         assert self.opt.optim_iters > 0, 'optimization iterations should be larger than 0'
+        self.tracking = hasattr(self.opt, 'tracking') and self.opt.tracking
+        self.tracking_iters = self.opt.tracking_iters if hasattr(self.opt, 'tracking_iters') else 20
+        self.tracking_min_score = self.opt.tracking_min_score if hasattr(self.opt, 'tracking_min_score') else 0.8
+        assert self.tracking_iters > 0, 'tracking iterations should be larger than 0'
+        # early stopping, every rule is disabled by default
+        self.optim_patience = self.opt.optim_patience if hasattr(self.opt, 'optim_patience') else 0
+        self.optim_min_delta = self.opt.optim_min_delta if hasattr(self.opt, 'optim_min_delta') else 0.0
+        self.optim_target_iou = self.opt.optim_target_iou if hasattr(self.opt, 'optim_target_iou') else None
+        self.optim_time_budget = self.opt.optim_time_budget if hasattr(self.opt, 'optim_time_budget') else None
+        assert self.optim_patience >= 0, 'patience should not be negative'
+        # the plateau / target IoU rules read the loss on the host, only every optim_check_interval iterations
+        self.optim_check_interval = self.opt.optim_check_interval if hasattr(self.opt, 'optim_check_interval') else 10
+        self.optim_loss_history = hasattr(self.opt, 'optim_loss_history') and self.opt.optim_loss_history
+        assert self.optim_check_interval > 0, 'check interval should be larger than 0'
+        self.optim_pyramid = self.parse_pyramid(self.opt.optim_pyramid) if hasattr(self.opt, 'optim_pyramid') else None
+        # l-bfgs keeps a dense history of the flattened parameters: only meant for the 8 corners of directh
+        assert self.opt.optim_type != 'lbfgs' or self.opt.optim_method == 'directh', 'lbfgs is only supported by directh'
+        self.lr_lbfgs = self.opt.lr_lbfgs if hasattr(self.opt, 'lr_lbfgs') else 1.0
+        self.lbfgs_history = self.opt.lbfgs_history if hasattr(self.opt, 'lbfgs_history') else 10
+        # multi-hypothesis cold start (directh): K perturbed corner sets per frame, optimized as one batch
+        self.num_hypotheses = self.opt.optim_hypotheses if hasattr(self.opt, 'optim_hypotheses') else 1
+        self.hypothesis_sigma = self.opt.hypothesis_sigma if hasattr(self.opt, 'hypothesis_sigma') else 0.05
+        assert self.num_hypotheses > 0, 'number of hypotheses should be larger than 0'
+
+    @staticmethod
+    def parse_pyramid(spec):
+        '''coarse-to-fine schedule, e.g. '64:120:1e-4,128:60,256:20'
+        each level is size:iters[:lr], size is the longest side of the frame used by the
+        loss surface at that level, lr defaults to lr_optim
+        '''
+        if not spec:
+            return None
+        levels = []
+        for level in spec.split(','):
+            fields = level.split(':')
+            assert len(fields) in (2, 3), 'pyramid level should be size:iters[:lr], got {0}'.format(level)
+            size, iters = int(fields[0]), int(fields[1])
+            lr = float(fields[2]) if len(fields) == 3 else None
+            assert size > 0 and iters > 0, 'pyramid sizes and iterations should be larger than 0'
+            levels.append((size, iters, lr))
+        return levels
+
+    def reset_tracking(self):
+        '''forget the previous frame, the next optimization starts cold
+        '''
+        self.tracking_state = None
+        # counted per frame: a batch of B frames adds B
+        self.tracking_stats = {'warm': 0, 'cold': 0, 'fallback': 0}
+        self.optim_stats = {'iterations': 0, 'stop_reason': None}
+
+    def start_time_budget(self):
+        '''the time budget covers the whole optim() call, warm start and fallback included
+        '''
+        self.deadline = time.perf_counter() + self.optim_time_budget if self.optim_time_budget else None
+        self.optim_stats = {'iterations': 0, 'stop_reason': None}
+
+    def use_warm_start(self, batch_size):
+        return self.tracking and self.tracking_state is not None and self.tracking_state['batch_size'] == batch_size
+
+    def get_score(self, loss):
+        '''the loss surface regresses the IoU and the target is 1,
+        so the predicted IoU can be read back from the loss
+        '''
+        if self.opt.optim_criterion == 'mse':
+            return 1.0 - np.sqrt(loss)
+        return 1.0 - loss
+
+    def get_best_score(self, best_loss):
+        '''mean predicted IoU, each sample at its best iteration
+        '''
+        return float(self.get_score(util.to_numpy(best_loss)).mean())
+
+    def get_stop_reason(self, iteration, best_loss, stale_iters):
+        '''check the early stopping rules, return None to keep optimizing
+        only the time budget is checked at every iteration, the other rules need
+        the loss on the host and are checked every optim_check_interval iterations
+        '''
+        if self.deadline is not None and time.perf_counter() >= self.deadline:
+            return 'time_budget'
+        if (iteration + 1) % self.optim_check_interval != 0:
+            return None
+        if self.optim_target_iou is not None and \
+                (self.get_score(util.to_numpy(best_loss)) >= self.optim_target_iou).all():
+            return 'target_iou'
+        if self.optim_patience > 0 and bool((stale_iters >= self.optim_patience).all()):
+            return 'plateau'
+        return None
 
     def build_criterion(self):
         if self.opt.optim_criterion == 'l1loss':
-            self.criterion = torch.nn.L1Loss(reduction='sum')
+            self.criterion = torch.nn.L1Loss(reduction='none')
         elif self.opt.optim_criterion == 'mse':
-            self.criterion = torch.nn.MSELoss(reduction='sum')
+            self.criterion = torch.nn.MSELoss(reduction='none')
         else:
             raise ValueError('unknown optimization criterion: {0}'.format(
                 self.opt.optim_criterion))
@@ -62,6 +165,9 @@ class End2EndOptim(abc.ABC):
             self.opt)
         self.optim_net = util.set_model_device(self.optim_net)
         self.optim_net.eval()
+        # only the input of the loss surface needs gradients, its weights can be frozen
+        example = util.set_tensor_device(torch.zeros(1, 3, 256, 256))
+        self.optim_net = inference_freeze.prepare_for_inference(self.optim_net, ((example, example),), self.opt)
         if self.opt.error_target == 'iou_whole':
             self.target_dist = torch.ones((1, 1), requires_grad=False)
             self.target_dist = util.set_tensor_device(self.target_dist)
@@ -73,118 +179,390 @@ class End2EndOptim(abc.ABC):
         self.homography_inference = end_2_end_optimization_helper.HomographyInferenceFactory.get_homography_inference(
             self.opt)
 
+    def get_base_lr(self):
+        '''for l-bfgs the learning rate is the initial step of the line search
+        '''
+        return self.lr_lbfgs if self.opt.optim_type == 'lbfgs' else self.opt.lr_optim
+
     def create_gd_optimizer(self, params):
-        optim_list = [{"params": params, "lr": self.opt.lr_optim}]
+        optim_list = [{"params": params, "lr": self.get_base_lr()}]
         if self.opt.optim_type == 'adam':
             optim = torch.optim.Adam(optim_list)
         elif self.opt.optim_type == 'sgd':
             optim = torch.optim.SGD(optim_list)
+        elif self.opt.optim_type == 'lbfgs':
+            # max_iter / max_eval are set by the optimization loop, a single step() runs all the iterations
+            optim = torch.optim.LBFGS(optim_list, max_iter=self.opt.optim_iters,
+                                      history_size=self.lbfgs_history, line_search_fn='strong_wolfe')
         else:
             raise ValueError(
                 'unknown optimization type: {0}'.format(self.opt.optim_type))
         return optim
 
-    def first_order_main_optimization_loop(self, frame, template, optim_tools, get_corners_fun, corner_to_mat_fun):
-        loss_hist = []
-        corners_optim_list = []
+    def first_order_main_optimization_loop(self, frame, template, optim_tools, get_corners_fun, corner_to_mat_fun, iters=None):
+        '''returns the best loss and the corners of each sample at its own best iteration
+        the running best is kept with detached tensors, so no autograd graph outlives
+        its iteration, and nothing is read back on the host in the inner loop
+        '''
         optimizer = optim_tools['optimizer']
         B = frame.shape[0]
-        for i in tqdm(range(0, self.opt.optim_iters)):
-            corners_optim = get_corners_fun()
-            corners_optim_list.append(corners_optim)
-            inferred_transformation_mat = corner_to_mat_fun(corners_optim)
-            warped_tmp = warp.warp_image(
-                template, inferred_transformation_mat, out_shape=frame.shape[-2:])
-            inferred_dist = self.optim_net((frame, warped_tmp))
-            optim_loss = self.get_loss(inferred_dist, self.target_dist.repeat(B, 1))
-            loss_hist.append(optim_loss.clone().detach().cpu().numpy())
-            if torch.isnan(optim_loss.data):
-                assert 0, 'loss is nan during optimization'
-            else:
+        if iters is None:
+            iters = self.opt.optim_iters
+        device = frame.device
+        best_loss = torch.full((B,), float('inf'), device=device)
+        best_corners = None
+        stale_iters = torch.zeros(B, dtype=torch.long, device=device)
+        nan_loss = torch.zeros((), dtype=torch.bool, device=device)
+        loss_hist = torch.empty((iters, B), device=device) if self.optim_loss_history else None
+        stop_reason = 'max_iters'
+        used_iters = 0
+        for i in tqdm(range(0, iters)):
+            with profiling.stage('optim_iteration'):
+                corners_optim = get_corners_fun()
+                inferred_transformation_mat = corner_to_mat_fun(corners_optim)
+                warped_tmp = warp.warp_image(
+                    template, inferred_transformation_mat, out_shape=frame.shape[-2:])
+                inferred_dist = self.optim_net((frame, warped_tmp))
+                sample_loss = self.get_loss(inferred_dist, self.target_dist.repeat(B, 1))
+                # the samples are independent: the gradient of the sum is the per-sample gradient
+                optim_loss = sample_loss.sum()
                 optimizer.zero_grad()
                 optim_loss.backward()
+
+                # the loss was computed with the corners before this step
+                sample_loss = sample_loss.detach()
+                nan_loss |= torch.isnan(sample_loss).any()
+                improved = sample_loss < best_loss
+                best_corners = corners_optim.detach().clone() if best_corners is None else \
+                    torch.where(improved[:, None, None], corners_optim.detach(), best_corners)
+                # plateau: per sample, iterations since the best loss improved by more than min_delta
+                stale_iters = torch.where(sample_loss < best_loss - self.optim_min_delta,
+                                          torch.zeros_like(stale_iters), stale_iters + 1)
+                best_loss = torch.where(improved, sample_loss, best_loss)
+                if loss_hist is not None:
+                    loss_hist[i] = sample_loss
                 optimizer.step()
-            if optim_loss.data < 0.000000:
+            used_iters = i + 1
+            reason = self.get_stop_reason(i, best_loss, stale_iters)
+            if reason is not None:
+                stop_reason = reason
                 break
-        loss_hist = np.array(loss_hist)
-        return loss_hist, corners_optim_list
+        if bool(nan_loss):
+            assert 0, 'loss is nan during optimization'
+        self.optim_stats = {'iterations': self.optim_stats['iterations'] + used_iters, 'stop_reason': stop_reason}
+        self.loss_hist = util.to_numpy(loss_hist[:used_iters]) if loss_hist is not None else None
+        return best_loss, best_corners
+
+    def quasi_newton_main_optimization_loop(self, frame, template, optim_tools, get_corners_fun, corner_to_mat_fun, iters=None):
+        '''l-bfgs with a strong wolfe line search, iters counts quasi-newton iterations
+        a single step() runs all of them, so no point is evaluated twice: the best corners
+        and the early stopping rules are checked inside the closure, at every evaluation
+        of the loss surface (line search included), and optim_stats['iterations'] counts
+        the evaluations since they are where the time goes
+        '''
+        optimizer = optim_tools['optimizer']
+        B = frame.shape[0]
+        if iters is None:
+            iters = self.opt.optim_iters
+        device = frame.device
+        best = {'loss': torch.full((B,), float('inf'), device=device), 'corners': None,
+                'nan': torch.zeros((), dtype=torch.bool, device=device)}
+        loss_hist = [] if self.optim_loss_history else None
+        # l-bfgs keeps its (global) state on the first parameter, n_iter counts the started iterations
+        lbfgs_state = optimizer.state[optimizer.param_groups[0]['params'][0]]
+        start_iter = lbfgs_state.get('n_iter', 0)
+        # plateau is measured per quasi-newton iteration, not per line search evaluation
+        progress = {'evaluations': 0, 'iteration': 0, 'best_loss': best['loss'],
+                    'stale_iters': torch.zeros(B, dtype=torch.long, device=device)}
+
+        def closure():
+            progress['evaluations'] += 1
+            with profiling.stage('optim_iteration'):
+                corners_optim = get_corners_fun()
+                inferred_transformation_mat = corner_to_mat_fun(corners_optim)
+                warped_tmp = warp.warp_image(
+                    template, inferred_transformation_mat, out_shape=frame.shape[-2:])
+                inferred_dist = self.optim_net((frame, warped_tmp))
+                sample_loss = self.get_loss(inferred_dist, self.target_dist.repeat(B, 1))
+                optim_loss = sample_loss.sum()
+                optimizer.zero_grad()
+                optim_loss.backward()
+
+                sample_loss = sample_loss.detach()
+                best['nan'] |= torch.isnan(sample_loss).any()
+                improved = sample_loss < best['loss']
+                best['corners'] = corners_optim.detach().clone() if best['corners'] is None else \
+                    torch.where(improved[:, None, None], corners_optim.detach(), best['corners'])
+                best['loss'] = torch.where(improved, sample_loss, best['loss'])
+                if loss_hist is not None:
+                    loss_hist.append(sample_loss)
+
+            # the line search reads the loss back anyway, the host side checks cost nothing more
+            if bool(best['nan']):
+                raise _OptimizationStopped('nan')
+            if self.deadline is not None and time.perf_counter() >= self.deadline:
+                raise _OptimizationStopped('time_budget')
+            iteration = lbfgs_state.get('n_iter', 0) - start_iter
+            if iteration > progress['iteration']:
+                # a new quasi-newton iteration started: the previous one is complete
+                progress['stale_iters'] = torch.where(best['loss'] < progress['best_loss'] - self.optim_min_delta,
+                                                      torch.zeros_like(progress['stale_iters']),
+                                                      progress['stale_iters'] + 1)
+                progress['best_loss'], progress['iteration'] = best['loss'], iteration
+                reason = self.get_stop_reason(iteration - 1, best['loss'], progress['stale_iters'])
+                if reason is not None:
+                    raise _OptimizationStopped(reason)
+            return optim_loss
+
+        # the default evaluation budget of torch, the line search needs a few more evaluations than iterations
+        max_eval = iters * 5 // 4
+        for group in optimizer.param_groups:
+            group['max_iter'] = iters
+            group['max_eval'] = max_eval
+        try:
+            optimizer.step(closure)
+            # otherwise step() returned early: the gradient or the change of the loss is below tolerance
+            out_of_budget = lbfgs_state.get('n_iter', 0) - start_iter >= iters or progress['evaluations'] >= max_eval
+            stop_reason = 'max_iters' if out_of_budget else 'converged'
+        except _OptimizationStopped as stop:
+            stop_reason = stop.reason
+        if bool(best['nan']):
+            assert 0, 'loss is nan during optimization'
+        self.optim_stats = {'iterations': self.optim_stats['iterations'] + progress['evaluations'],
+                            'stop_reason': stop_reason}
+        self.loss_hist = util.to_numpy(torch.stack(loss_hist)) if loss_hist else None
+        return best['loss'], best['corners']
+
+    def prepare_template_pyramid(self, template, frame_shape=(256, 256)):
+        '''downsample the (fixed) template once for every level of the pyramid
+        '''
+        self.template_pyramid = {'template': template, 'levels': {}}
+        for size, _, _ in self.optim_pyramid or []:
+            if size < max(frame_shape):
+                self.get_template_level(template, size / max(frame_shape))
+
+    def get_template_level(self, template, scale):
+        '''template downsampled by the same factor as the frame, cached per scale
+        '''
+        if self.template_pyramid is None or self.template_pyramid['template'] is not template:
+            self.template_pyramid = {'template': template, 'levels': {}}
+        levels = self.template_pyramid['levels']
+        if scale not in levels:
+            if template.dim() == 3:
+                template = template[None]
+            level_shape = (max(1, round(template.shape[-2] * scale)), max(1, round(template.shape[-1] * scale)))
+            with torch.no_grad():
+                levels[scale] = F.interpolate(template, size=level_shape, mode='area')
+        return levels[scale]
+
+    def get_pyramid_level(self, frame, template, size):
+        '''frame and template for one level of the pyramid, the full resolution when size is None
+        '''
+        B = frame.shape[0]
+        if size is None or size >= max(frame.shape[-2:]):
+            template = template[None] if template.dim() == 3 else template
+            return frame, template.expand(B, -1, -1, -1)
+        scale = size / max(frame.shape[-2:])
+        frame_shape = (max(1, round(frame.shape[-2] * scale)), max(1, round(frame.shape[-1] * scale)))
+        frame_level = F.interpolate(frame, size=frame_shape, mode='area')
+        template_level = self.get_template_level(template, scale)
+        return frame_level, template_level.expand(B, -1, -1, -1)
 
     def get_loss(self, output, target):
+        '''loss of each sample, shape (B,)
+        '''
         optim_loss = self.criterion(output, target)
-        return optim_loss
+        return optim_loss.reshape(optim_loss.shape[0], -1).sum(dim=1)
 
-    def main_optimization_loop(self, frame, template, optim_tools, get_corners_fun, corner_to_mat_fun):
-        if self.opt.optim_type == 'adam' or 'sgd':
-            loss_hist, corners_optim_list = self.first_order_main_optimization_loop(
-                frame, template, optim_tools, get_corners_fun, corner_to_mat_fun)
+    def main_optimization_loop(self, frame, template, optim_tools, get_corners_fun, corner_to_mat_fun, iters=None):
+        '''without iters, a cold optimization: follows the coarse-to-fine pyramid if one is configured
+        losses are only comparable within a level, the best iterate comes from the last level that ran
+        '''
+        if iters is None and self.optim_pyramid:
+            levels = self.optim_pyramid
         else:
-            raise ValueError(
-                'unknown optimization type: {0}'.format(self.opt.optim_type))
-        return loss_hist, corners_optim_list
+            levels = [(None, iters if iters is not None else self.opt.optim_iters, None)]
+        optimizer = optim_tools['optimizer']
+        for size, level_iters, lr in levels:
+            frame_level, template_level = self.get_pyramid_level(frame, template, size)
+            for group in optimizer.param_groups:
+                group['lr'] = lr if lr is not None else self.get_base_lr()
+            if self.opt.optim_type in ('adam', 'sgd'):
+                best_loss, best_corners = self.first_order_main_optimization_loop(
+                    frame_level, template_level, optim_tools, get_corners_fun, corner_to_mat_fun, iters=level_iters)
+            elif self.opt.optim_type == 'lbfgs':
+                # the curvature pairs of a coarser level belong to a different objective: start afresh
+                optimizer.state.clear()
+                best_loss, best_corners = self.quasi_newton_main_optimization_loop(
+                    frame_level, template_level, optim_tools, get_corners_fun, corner_to_mat_fun, iters=level_iters)
+            else:
+                raise ValueError(
+                    'unknown optimization type: {0}'.format(self.opt.optim_type))
+            if self.optim_stats['stop_reason'] == 'time_budget':
+                break
+        return best_loss, best_corners
 
     @abc.abstractmethod
-    def optim(self, frame, template, refresh=True):
+    def optim(self, frame, template, refresh=True, upstream_homography=None):
+        '''upstream_homography: optional initial guess, already inferred by the
+        upstream network with its pretrained weights (e.g. for a whole batch of frames)
+        '''
         pass
 
 
 class End2EndOptimDirectH(End2EndOptim):
-    def optim(self, frame, template, refresh=True):
+    def optim(self, frame, template, refresh=True, upstream_homography=None):
         def get_corners_directh():
             return corners_optim
 
         def corner_to_mat_directh(corners):
             return end_2_end_optimization_helper.get_homography_between_corners_and_default_canon4pts(corners, self.opt.directh_part)
 
+        def run(init_corners, iters, frames):
+            nonlocal corners_optim
+            corners_optim = init_corners.detach().clone(memory_format=torch.contiguous_format).requires_grad_(True)
+            optim = self.create_gd_optimizer(params=corners_optim)
+            optim_tools = {'optimizer': optim}
+            return self.main_optimization_loop(frames,
+                                               template,
+                                               optim_tools,
+                                               get_corners_directh,
+                                               corner_to_mat_directh,
+                                               iters=iters)
+
+        self.start_time_budget()
+        B = frame.shape[0]
+        corners_optim = None
+
+        if self.use_warm_start(B):
+            # tracking: start from the corners optimized on the previous frame
+            self.tracking_stats['warm'] += B
+            prev_corners = self.tracking_state['corners']
+            best_loss, best_corners = run(prev_corners, self.tracking_iters, frame)
+            orig_homography = corner_to_mat_directh(prev_corners)
+            # out of time there is no point in a cold start: keep the best warm result
+            if self.get_best_score(best_loss) >= self.tracking_min_score or \
+                    self.optim_stats['stop_reason'] == 'time_budget':
+                self.tracking_state = {'batch_size': B, 'corners': best_corners}
+                return orig_homography, corner_to_mat_directh(best_corners)
+            self.tracking_stats['fallback'] += B
+
+        self.tracking_stats['cold'] += B
         self.homography_inference.refresh()
         assert self.homography_inference.get_training_status(
         ) is False, 'set model to eval mode at optimization stage'
         assert self.optim_net.training is False, 'set model to eval mode at optimization stage'
-        B = frame.shape[0]
 
-        template = template.repeat(B, 1, 1, 1)
-        upstream_homography = self.homography_inference.infer_upstream_homography(frame)
+        if upstream_homography is None:
+            # only the corners are optimized, the upstream network needs no gradient
+            with profiling.stage('homography_init_guess'), torch.no_grad():
+                upstream_homography = self.homography_inference.infer_upstream_homography(frame)
         # canon4pts would be full or lower based on the options
         canon4pts = end_2_end_optimization_helper.get_default_canon4pts(B, canon4pts_type=self.opt.directh_part)
 
-        corners_optim = warp.get_four_corners(upstream_homography, canon4pts=canon4pts[0])
-        corners_optim = corners_optim.permute(0, 2, 1)
-        corners_optim = corners_optim.clone().detach().requires_grad_(True)
-        optim = self.create_gd_optimizer(params=corners_optim)
-        optim_tools = {'optimizer': optim}
-        loss_hist, corners_optim_list = self.main_optimization_loop(frame,
-                                                                    template,
-                                                                    optim_tools,
-                                                                    get_corners_directh,
-                                                                    corner_to_mat_directh)
+        init_corners = warp.get_four_corners(upstream_homography, canon4pts=canon4pts[0])
+        init_corners = init_corners.permute(0, 2, 1)
+        K = self.num_hypotheses
+        if K == 1:
+            best_loss, best_corners = run(init_corners, None, frame)
+        else:
+            # every hypothesis is an independent sample of the batch, the loss surface sees B * K pairs
+            hypotheses = end_2_end_optimization_helper.get_corner_hypotheses(init_corners, K, self.hypothesis_sigma)
+            best_loss, best_corners = run(hypotheses, None, frame.repeat_interleave(K, dim=0))
+            best_loss, best_hypothesis = best_loss.reshape(B, K).min(dim=1)
+            best_corners = best_corners.reshape(B, K, 4, 2)[torch.arange(B, device=best_corners.device), best_hypothesis]
+            self.optim_stats['best_hypothesis'] = best_hypothesis.tolist()
 
         orig_homography = upstream_homography
-        optim_homography = corner_to_mat_directh(corners_optim_list[loss_hist.argmin()])
+        if self.tracking:
+            self.tracking_state = {'batch_size': B, 'corners': best_corners}
+        optim_homography = corner_to_mat_directh(best_corners)
         return orig_homography, optim_homography
 
 
 class End2EndOptimSTN(End2EndOptim):
-    def optim(self, frame, template, refresh=True):
-        def get_corners_stn():
-            return self.homography_inference.infer_upstream_corners(frame)
+    '''optimize the parameters of the upstream network
+    a single frame updates the network in place, a batch of B frames optimizes
+    B copies of the parameters together (one vectorized forward/backward per iteration)
+    '''
 
+    def optim(self, frame, template, refresh=True, upstream_homography=None):
         def corner_to_mat_stn(corners):
             return end_2_end_optimization_helper.get_homography_between_corners_and_default_canon4pts(corners, 'lower')
 
-        if refresh:
-            self.homography_inference.refresh()
-        assert self.homography_inference.get_training_status() is False, 'set model to eval mode at optimization stage'
-        assert self.optim_net.training is False, 'set model to eval mode at optimization stage'
+        def run(frame, params, iters, upstream_homography=None):
+            def get_corners_stn():
+                return self.homography_inference.infer_upstream_corners(frame, params)
+
+            if upstream_homography is None:
+                # returned as the original homography only, no gradient needed
+                with profiling.stage('homography_init_guess'), torch.no_grad():
+                    upstream_homography = self.homography_inference.infer_upstream_homography(frame, params)
+            optim = self.create_gd_optimizer(params=self.homography_inference.get_upstream_params()
+                                             if params is None else list(params.values()))
+            optim_tools = {'optimizer': optim}
+            best_loss, best_corners = self.main_optimization_loop(frame,
+                                                                  template,
+                                                                  optim_tools,
+                                                                  get_corners_stn,
+                                                                  corner_to_mat_stn,
+                                                                  iters=iters)
+            return upstream_homography, best_loss, best_corners
+
+        self.start_time_budget()
         B = frame.shape[0]
-        assert B == 1, 'STN optimization only support one image at a time'
-
-        upstream_homography = self.homography_inference.infer_upstream_homography(frame)
-        optim = self.create_gd_optimizer(params=self.homography_inference.get_upstream_params())
-        optim_tools = {'optimizer': optim}
-        loss_hist, corners_optim_list = self.main_optimization_loop(frame,
-                                                                    template,
-                                                                    optim_tools,
-                                                                    get_corners_stn,
-                                                                    corner_to_mat_stn)
+        params = None
+        initial_guess = upstream_homography
+
+        if self.use_warm_start(B):
+            # tracking: keep the upstream parameters optimized on the previous frame
+            self.tracking_stats['warm'] += B
+            params = self.tracking_state['params']
+            upstream_homography, best_loss, best_corners = run(frame, params, self.tracking_iters)
+            if params is not None:
+                # batch: every sample keeps or loses track on its own
+                lost_samples = np.flatnonzero(self.get_score(util.to_numpy(best_loss)) < self.tracking_min_score)
+            else:
+                lost_samples = np.arange(B) if self.get_best_score(best_loss) < self.tracking_min_score else np.arange(0)
+            # out of time there is no point in a cold start: keep the best warm result
+            if self.optim_stats['stop_reason'] == 'time_budget':
+                lost_samples = np.arange(0)
+            self.tracking_stats['fallback'] += len(lost_samples)
+            if 0 < len(lost_samples) < B:
+                # only the lost samples restart from the pretrained weights, as a sub-batch;
+                # the warm results of the others are kept
+                self.tracking_stats['cold'] += len(lost_samples)
+                self.homography_inference.refresh(params, lost_samples)
+                lost = torch.as_tensor(lost_samples, device=frame.device)
+                lost_params = {k: v.detach()[lost].clone().requires_grad_(True) for k, v in params.items()}
+                lost_homography, lost_loss, lost_corners = run(frame[lost], lost_params, None)
+                with torch.no_grad():
+                    for k, v in params.items():
+                        v[lost] = lost_params[k]
+                upstream_homography, best_loss, best_corners = \
+                    upstream_homography.clone(), best_loss.clone(), best_corners.clone()
+                upstream_homography[lost] = lost_homography
+                best_loss[lost] = lost_loss
+                best_corners[lost] = lost_corners
+            cold_start = len(lost_samples) == B
+            if cold_start:
+                refresh = True
+        else:
+            cold_start = True
+        if cold_start:
+            self.tracking_stats['cold'] += B
+            if refresh:
+                self.homography_inference.refresh()
+            else:
+                # a precomputed initial guess is only valid for the pristine upstream weights
+                initial_guess = None
+            params = self.homography_inference.get_per_sample_params(B) if B > 1 else None
+            assert self.homography_inference.get_training_status() is False, 'set model to eval mode at optimization stage'
+            assert self.optim_net.training is False, 'set model to eval mode at optimization stage'
+            upstream_homography, best_loss, best_corners = run(frame, params, None, initial_guess)
+
+        if self.tracking:
+            self.tracking_state = {'batch_size': B, 'params': params}
         orig_homography = upstream_homography
-        optim_homography = end_2_end_optimization_helper.get_homography_between_corners_and_default_canon4pts(corners_optim_list[loss_hist.argmin()], 'lower')
+        optim_homography = end_2_end_optimization_helper.get_homography_between_corners_and_default_canon4pts(best_corners, 'lower')
         return orig_homography, optim_homography
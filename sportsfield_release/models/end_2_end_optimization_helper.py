@@ -1,22 +1,23 @@
 import abc
 
 import numpy as np
+import torch
 
 from sportsfield_release.utils import util
-from . import init_guesser
+from . import inference_freeze, init_guesser
+
+
+# the source points are constant, closed form solvers with their part precomputed
+_CANON4PTS_TRANSFORMS = {
+    'lower': util.RectToQuadTransform(util.LOWER_CANON4PTS_NP()),
+    'full': util.RectToQuadTransform(util.FULL_CANON4PTS_NP()),
+}
 
 
 def get_homography_between_corners_and_default_canon4pts(corners, canon4pts_type: str):
-    batch_size = corners.shape[0]
-    if canon4pts_type == 'lower':
-        lower_canon4pts = get_default_canon4pts(batch_size, canon4pts_type)
-        homography = util.get_perspective_transform(lower_canon4pts, corners)
-    elif canon4pts_type == 'full':
-        full_canon4pts = get_default_canon4pts(batch_size, canon4pts_type)
-        homography = util.get_perspective_transform(full_canon4pts, corners)
-    else:
+    if canon4pts_type not in _CANON4PTS_TRANSFORMS:
         raise ValueError('unknown canon4pts type')
-    return homography
+    return _CANON4PTS_TRANSFORMS[canon4pts_type](corners)
 
 
 def get_default_canon4pts(batch_size, canon4pts_type: str):
@@ -34,6 +35,29 @@ def get_default_canon4pts(batch_size, canon4pts_type: str):
         raise ValueError('unknown canon4pts type')
 
 
+def get_corner_hypotheses(corners, num_hypotheses: int, sigma: float, seed: int = 0):
+    '''K hypotheses around each set of corners, (B, 4, 2) -> (B * K, 4, 2), hypotheses of a frame are contiguous
+    the first hypothesis is the unperturbed guess, the others move the whole quad (shift and zoom
+    around its centroid, a different camera pose) and jitter every corner; the noise is seeded so
+    that the same frame always gives the same result
+    '''
+    B = corners.shape[0]
+    hypotheses = corners[:, None].repeat(1, num_hypotheses, 1, 1)
+    if num_hypotheses == 1:
+        return hypotheses.reshape(B, 4, 2)
+    generator = torch.Generator().manual_seed(seed)
+    shape = (B, num_hypotheses - 1)
+    shift = torch.randn(*shape, 1, 2, generator=generator) * sigma
+    zoom = torch.exp(torch.randn(*shape, 1, 1, generator=generator) * sigma)
+    jitter = torch.randn(*shape, 4, 2, generator=generator) * sigma / 2
+    perturbation = [t.to(device=corners.device, dtype=corners.dtype) for t in (shift, zoom, jitter)]
+    shift, zoom, jitter = perturbation
+    others = hypotheses[:, 1:]
+    centroid = others.mean(dim=2, keepdim=True)
+    hypotheses[:, 1:] = (others - centroid) * zoom + centroid + shift + jitter
+    return hypotheses.reshape(B * num_hypotheses, 4, 2)
+
+
 class HomographyInferenceFactory(object):
     @staticmethod
     def get_homography_inference(opt):
@@ -68,38 +92,74 @@ class HomographyInference(abc.ABC):
             self.opt)
         self.upstream = util.set_model_device(self.upstream)
         self.upstream.eval()
-
-    def refresh(self):
-        self.upstream.load_pretrained_weights()
+        self.upstream_runtime = self.upstream
+        if self.opt.optim_method == 'directh':
+            # directh never optimizes the upstream, it can be frozen (stn optimizes its weights)
+            example = util.set_tensor_device(torch.zeros(1, 3, 256, 256))
+            self.upstream_runtime = inference_freeze.prepare_for_inference(self.upstream, (example,), self.opt)
+        # pristine weights (key names already resolved), refresh() restores them from memory
+        self.upstream.snapshot_weights()
+
+    def refresh(self, params=None, samples=None):
+        '''restore the pretrained upstream weights with an in-place copy, no disk access
+        with per-sample params (see get_per_sample_params) restore those instead,
+        optionally only the given samples
+        '''
+        if params is None:
+            self.upstream.restore_weights()
+        else:
+            self.upstream.restore_weights_into(params, samples)
 
     def get_upstream_params(self):
         assert self.opt.guess_model == 'init_guess'
         return self.upstream.parameters()
 
+    def get_per_sample_params(self, batch_size):
+        '''one copy of the upstream parameters for each sample of a batch, stacked on dim 0
+        '''
+        return {name: param.detach().unsqueeze(0).repeat(batch_size, *([1] * param.dim())).requires_grad_(True)
+                for name, param in self.upstream.named_parameters()}
+
+    def forward_upstream(self, frame, params=None):
+        '''run the upstream network; with per-sample params (see get_per_sample_params)
+        each sample goes through its own parameters in a single vectorized call
+        '''
+        if params is None:
+            return self.upstream_runtime(frame)
+        # the resnet is called directly: memory format changes are not supported inside vmap
+        prefix = 'feature_extractor.'
+        network = self.upstream.feature_extractor
+        buffers = {k[len(prefix):]: v for k, v in self.upstream.named_buffers()}
+        params = {k[len(prefix):]: v for k, v in params.items()}
+
+        def forward(sample_params, sample):
+            return torch.func.functional_call(network, (sample_params, buffers), (sample[None],))[0]
+        with util.autocast():
+            y = torch.func.vmap(forward)(params, frame)
+        return y.float()
+
     def get_training_status(self) -> bool:
         return self.upstream.training
 
     @abc.abstractmethod
-    def infer_upstream_homography(self, frame):
+    def infer_upstream_homography(self, frame, params=None):
         pass
 
     @abc.abstractmethod
-    def infer_upstream_corners(self, frame):
+    def infer_upstream_corners(self, frame, params=None):
         pass
 
 
 class HomographyInferenceDeepHomo(HomographyInference):
 
-    def infer_upstream_corners(self, frame):
+    def infer_upstream_corners(self, frame, params=None):
         self.upstream.eval()
-        inferred_corners_orig = self.upstream(frame)
+        inferred_corners_orig = self.forward_upstream(frame, params)
         inferred_corners_orig = inferred_corners_orig.reshape(-1, 2, 4)
         inferred_corners_orig = inferred_corners_orig.permute(0, 2, 1)
         return inferred_corners_orig
 
-    def infer_upstream_homography(self, frame):
-        batch_size = frame.shape[0]
-        inferred_corners_orig = self.infer_upstream_corners(frame)
-        lower_canon4pts = get_default_canon4pts(batch_size, canon4pts_type='lower')
-        homography = util.get_perspective_transform(lower_canon4pts, inferred_corners_orig)
+    def infer_upstream_homography(self, frame, params=None):
+        inferred_corners_orig = self.infer_upstream_corners(frame, params)
+        homography = get_homography_between_corners_and_default_canon4pts(inferred_corners_orig, 'lower')
         return homography
@@ -0,0 +1,117 @@
+'''
+load-time preparation of a network that is only used for inference:
+the spectral norm weights are materialised, batch norm is folded into the
+preceding convolution, and the result can be traced with torchscript and
+cached on disk. the frozen network stays differentiable w.r.t. its input.
+'''
+
+import hashlib
+import os
+
+import torch
+from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from . import resnet
+from sportsfield_release.utils import constant_var, util
+
+
+def remove_spectral_norm(model):
+    '''replace every spectral normalised weight by its current value
+    in eval mode the power iteration is not run, so the output does not change
+    '''
+    for module in model.modules():
+        if hasattr(module, 'weight_orig'):
+            nn.utils.remove_spectral_norm(module, name='weight')
+    return model
+
+
+def _fold_pair(parent, conv_name, bn_name):
+    conv, bn = getattr(parent, conv_name), getattr(parent, bn_name)
+    if isinstance(bn, nn.BatchNorm2d):
+        setattr(parent, conv_name, fuse_conv_bn_eval(conv, bn))
+        setattr(parent, bn_name, nn.Identity())
+
+
+def fold_batch_norm(model):
+    '''fold the (eval mode) batch norms of the resnet blocks into their convolutions
+    group norm depends on the input statistics and is left as it is
+    '''
+    for module in list(model.modules()):
+        if isinstance(module, (resnet.ResNet, resnet.BasicBlock)):
+            _fold_pair(module, 'conv1', 'bn1')
+        if isinstance(module, resnet.BasicBlock):
+            _fold_pair(module, 'conv2', 'bn2')
+        if isinstance(module, resnet.Bottleneck):
+            for i in (1, 2, 3):
+                _fold_pair(module, 'conv{0}'.format(i), 'bn{0}'.format(i))
+        if isinstance(getattr(module, 'downsample', None), nn.Sequential):
+            _fold_pair(module.downsample, '0', '1')
+    return model
+
+
+def freeze(model):
+    '''in place: eval mode, spectral norm removed, batch norm folded, no parameter gradients
+    not for a network whose parameters are optimized (the upstream of stn)
+    '''
+    model.eval()
+    remove_spectral_norm(model)
+    fold_batch_norm(model)
+    # the folded convolutions are new modules, bring them to the device and memory format of the profile
+    util.set_model_device(model)
+    for param in model.parameters():
+        param.requires_grad_(False)
+    return model
+
+
+def get_weights_digest(model):
+    digest = hashlib.sha256()
+    digest.update(torch.__version__.encode())
+    digest.update(type(model).__name__.encode())
+    # the trace bakes in the memory format and the autocast of the cpu profile
+    digest.update('{0}|{1}'.format(constant_var.CHANNELS_LAST, constant_var.BF16_AUTOCAST).encode())
+    for k, v in model.state_dict().items():
+        digest.update(k.encode())
+        digest.update(util.to_numpy(v).tobytes())
+    return digest.hexdigest()
+
+
+def trace_cached(model, example_inputs, cache_dir):
+    '''torchscript trace of a frozen model, saved under cache_dir and keyed by its weights,
+    so later startups load it instead of tracing again
+    '''
+    device = next(model.parameters()).device
+    path = os.path.join(cache_dir, '{0}-{1}.pt'.format(model.name, get_weights_digest(model)[:16]))
+    if os.path.isfile(path):
+        try:
+            traced = torch.jit.load(path, map_location=device)
+            traced.eval()
+            return traced
+        except RuntimeError:
+            # corrupted or written by an incompatible torch: trace again
+            pass
+    traced = torch.jit.trace(model, example_inputs, check_trace=False)
+    os.makedirs(cache_dir, exist_ok=True)
+    # atomic write, other processes may be loading the same artifact
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    torch.jit.save(traced, tmp_path)
+    os.replace(tmp_path, path)
+    content_list = []
+    content_list += ['Traced {0} for inference'.format(model.name)]
+    content_list += ['Saved to: {0}'.format(path)]
+    util.print_notification(content_list)
+    return traced
+
+
+def prepare_for_inference(model, example_inputs, opt):
+    '''freeze the model in place according to the options,
+    returns what should be called at inference: the model itself or its torchscript trace
+    '''
+    if not (hasattr(opt, 'inference_freeze') and opt.inference_freeze):
+        return model
+    freeze(model)
+    if not (hasattr(opt, 'inference_trace') and opt.inference_trace):
+        return model
+    cache_dir = opt.inference_cache_dir if hasattr(opt, 'inference_cache_dir') and opt.inference_cache_dir \
+        else os.path.join(opt.out_dir, 'inference_cache')
+    return trace_cached(model, example_inputs, cache_dir)
@@ -74,9 +74,10 @@ class InitialGuesser(base_model.BaseModel, torch.nn.Module):
         return resnet_config
 
     def forward(self, x):
-        video = x
-        y = self.feature_extractor(video)
-        return y
+        video = util.set_memory_format(x)
+        with util.autocast():
+            y = self.feature_extractor(video)
+        return y.float()
 
     def load_pretrained_weights(self):
         '''load pretrained weights
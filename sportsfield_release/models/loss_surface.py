@@ -136,6 +136,8 @@ class LossSurfaceRegressor(BaseErrorModel):
     def forward(self, x):
         video, template = x
         image_stack = torch.cat((video, template), 1)  # stack along channel
-        y = self.feature_extractor(image_stack)
-        y = self.make_value_positive(y)
+        image_stack = util.set_memory_format(image_stack)
+        with util.autocast():
+            y = self.feature_extractor(image_stack)
+        y = self.make_value_positive(y.float())
         return y
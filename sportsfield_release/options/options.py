@@ -93,10 +93,24 @@ def set_end2end_optim_options():
                         default=0, help='0 is batch norm, otherwise means number of groups')
     parser.add_argument('--group_norm_error_model', type=int,
                         default=0, help='0 is batch norm, otherwise means number of groups')
+    parser.add_argument('--cpu_threads', type=int, default=None,
+                        help='intra-op threads of torch, default: torch decides')
+    parser.add_argument('--cpu_interop_threads', type=int, default=None,
+                        help='inter-op threads of torch, default: torch decides')
+    parser.add_argument('--channels_last', type=str2bool, default=False,
+                        help='run the resnets on channels_last (nhwc) tensors')
+    parser.add_argument('--bf16_autocast', type=str2bool, default=False,
+                        help='bfloat16 autocast on cpu for the resnets, forward and backward')
+    parser.add_argument('--inference_freeze', type=str2bool, default=False,
+                        help='at load time, materialise spectral norm and fold batch norm of the networks used for inference only')
+    parser.add_argument('--inference_trace', type=str2bool, default=False,
+                        help='with inference_freeze, trace the frozen networks with torchscript and cache them on disk')
+    parser.add_argument('--inference_cache_dir', type=str, default=None,
+                        help='where the traced networks are cached, out_dir/inference_cache by default')
     parser.add_argument('--optim_method', default='directh', choices=[
                         'stn', 'directh'], help='optimization method')
     parser.add_argument('--optim_type', default='adam',
-                        choices=['adam', 'sgd'], help='gradient descent optimizer type')
+                        choices=['adam', 'sgd', 'lbfgs'], help='gradient descent optimizer type, lbfgs only for directh')
     parser.add_argument('--directh_part', default='lower', choices=[
                         'full', 'lower'], help='optimize the lower 4 corners, or full 4 corners')
     parser.add_argument('--optim_criterion', default='l1loss',
@@ -105,6 +119,34 @@ def set_end2end_optim_options():
                         default=1e-3, help='optimization learning rate')
     parser.add_argument('--optim_iters', type=int, default=400,
                         help='iterations for optimization')
+    parser.add_argument('--lr_lbfgs', type=float, default=1.0,
+                        help='initial step of the lbfgs line search')
+    parser.add_argument('--lbfgs_history', type=int, default=10,
+                        help='number of past updates kept by lbfgs')
+    parser.add_argument('--optim_hypotheses', type=int, default=1,
+                        help='directh cold start: perturbed corner hypotheses per frame, optimized together, the best is kept')
+    parser.add_argument('--hypothesis_sigma', type=float, default=0.05,
+                        help='scale of the hypothesis perturbations, in normalized image coordinates')
+    parser.add_argument('--tracking', type=str2bool, default=False,
+                        help='warm start each optimization from the previous frame (video sequences)')
+    parser.add_argument('--tracking_iters', type=int, default=20,
+                        help='iterations for a warm started optimization')
+    parser.add_argument('--tracking_min_score', type=float, default=0.8,
+                        help='fall back to a cold start when the loss surface score drops below this value')
+    parser.add_argument('--optim_patience', type=int, default=0,
+                        help='stop after this many iterations without improvement (0: disabled)')
+    parser.add_argument('--optim_min_delta', type=float, default=0.0,
+                        help='minimum loss decrease that counts as an improvement')
+    parser.add_argument('--optim_target_iou', type=float, default=None,
+                        help='stop once the loss surface predicts at least this IoU')
+    parser.add_argument('--optim_time_budget', type=float, default=None,
+                        help='wall-clock budget in seconds per optimization, the best homography so far is returned')
+    parser.add_argument('--optim_check_interval', type=int, default=10,
+                        help='read the loss back for the plateau / target IoU rules every N iterations')
+    parser.add_argument('--optim_loss_history', type=str2bool, default=False,
+                        help='keep the per-iteration loss of each sample (End2EndOptim.loss_hist)')
+    parser.add_argument('--optim_pyramid', type=str, default=None,
+                        help='coarse-to-fine schedule for cold starts, size:iters[:lr] per level, e.g. 64:120:1e-4,128:60,256:20')
     parser.add_argument('--batch_size', type=int, default=1,
                         help='batch size for optimization')
     parser.add_argument('--iou_space', default='part_and_whole', choices=[
@@ -4,7 +4,7 @@ import time
 from torch.utils.data import DataLoader
 import numpy as np
 
-from sportsfield_release.utils import util
+from sportsfield_release.utils import util, profiling
 from utils import metrics
 from models import end_2_end_optimization
 from options import options
@@ -17,11 +17,13 @@ def main():
     opt = options.set_end2end_optim_options()
     opt.device = 'cpu'  # Forza CPU
     assert opt.iou_space == 'part_and_whole'
+    util.apply_cpu_profile(opt.cpu_threads, opt.cpu_interop_threads, opt.channels_last, opt.bf16_autocast)
 
     test_dataset = aligned_dataset.AlignedDatasetFactory.get_aligned_dataset(opt, 'test')
     test_loader = DataLoader(test_dataset, batch_size=opt.batch_size, shuffle=False, num_workers=0,)
 
     e2e = end_2_end_optimization.End2EndOptimFactory.get_end_2_end_optimization_model(opt)
+    e2e.prepare_template_pyramid(test_dataset.template)
 
     iou = metrics.IOU(opt)
     orig_iou_list = []
@@ -29,11 +31,14 @@ def main():
     original_homography_list = []
     optim_homography_list = []
     gt_homography_list = []
+    optim_iterations_list = []
     t0 = time.time()
     for i, data_batch in enumerate(test_loader):
         frame, _, gt_homography = data_batch
-        orig_homography, optim_homography = e2e.optim(
-            frame, test_dataset.template)
+        with profiling.stage('end2end_optim'):
+            orig_homography, optim_homography = e2e.optim(
+                frame, test_dataset.template)
+        optim_iterations_list.append(e2e.optim_stats['iterations'])
         orig_iou = iou(orig_homography, gt_homography)
         optim_iou = iou(optim_homography, gt_homography)
         orig_iou_list.append(orig_iou)
@@ -58,9 +63,14 @@ def main():
     print('optimized IOU part median:', np.median(optim_iou_part_list))
     print('optimized IOU whole mean:', optim_iou_whole_list.mean())
     print('optimized IOU whole median:', np.median(optim_iou_whole_list))
+    print('optimization iterations mean:', np.mean(optim_iterations_list))
+    print('optimization pyramid:', opt.optim_pyramid if opt.optim_pyramid else 'none')
+    print('cpu profile:', util.get_cpu_profile())
     print('----- -----')
     print('spent {0} seconds for {1} images'.format((t1 - t0), (optim_iou_whole_list.shape[0])))
     print('{0} seconds per single image'.format((t1 - t0) / (optim_iou_whole_list.shape[0])))
+    if profiling.is_enabled():
+        profiling.print_summary()
     print('----- End -----')
 
 
@@ -2,3 +2,12 @@ import torch
 
 HAS_CUDA = torch.cuda.is_available()
 USE_CUDA = False
+
+# cpu execution profile, set with util.apply_cpu_profile
+# threads: None keeps the torch defaults
+CPU_THREADS = None
+CPU_INTEROP_THREADS = None
+# resnet inputs and weights in channels_last (nhwc) memory format
+CHANNELS_LAST = False
+# bfloat16 autocast for the forward (and so the backward) of the resnets
+BF16_AUTOCAST = False
@@ -0,0 +1,145 @@
+'''per-stage latency instrumentation
+
+usage:
+    with profiling.stage('yolo'):
+        ...
+
+every stage records wall time and CPU time of the whole process, so the work of
+the torch / opencv intra-op threads is included. within a batch worker or the cli
+the stages never overlap and the CPU time is the stage's own; in the service,
+where requests run concurrently, it is an upper bound. the samples are
+aggregated into percentiles (p50/p95/p99) and can be exported as JSON.
+the instrumentation can be switched on/off at runtime (or with the
+OFFSIDE_PROFILE environment variable); when off, stage() returns a shared
+no-op context manager.
+'''
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+MAX_SAMPLES_PER_STAGE = 10000
+
+_enabled = os.environ.get('OFFSIDE_PROFILE', '') not in ('', '0')
+_lock = threading.Lock()
+_samples = {}
+_NULL_STAGE = contextlib.nullcontext()
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    with _lock:
+        _samples.clear()
+
+
+def record(name, wall, cpu):
+    with _lock:
+        if name not in _samples:
+            _samples[name] = deque(maxlen=MAX_SAMPLES_PER_STAGE)
+        _samples[name].append((wall, cpu))
+
+
+class _Stage(object):
+    __slots__ = ('name', 'wall', 'cpu')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record(self.name, time.perf_counter() - self.wall, time.process_time() - self.cpu)
+        return False
+
+
+def stage(name):
+    if not _enabled:
+        return _NULL_STAGE
+    return _Stage(name)
+
+
+def timed(name):
+    '''decorator version of stage()
+    '''
+    def decorator(fun):
+        @functools.wraps(fun)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fun(*args, **kwargs)
+            with _Stage(name):
+                return fun(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def take_totals():
+    '''return the total (wall, cpu) per stage recorded so far, and clear the samples
+    used to ship the timings of one work item to another process
+    '''
+    with _lock:
+        totals = {name: [sum(s[0] for s in samples), sum(s[1] for s in samples)]
+                  for name, samples in _samples.items()}
+        _samples.clear()
+    return totals
+
+
+def _describe(values):
+    values = np.asarray(values)
+    return {
+        'mean': float(values.mean()),
+        'p50': float(np.percentile(values, 50)),
+        'p95': float(np.percentile(values, 95)),
+        'p99': float(np.percentile(values, 99)),
+        'max': float(values.max()),
+        'total': float(values.sum()),
+    }
+
+
+def summary():
+    with _lock:
+        snapshot = {name: list(samples) for name, samples in _samples.items()}
+    result = {}
+    for name, samples in sorted(snapshot.items()):
+        result[name] = {
+            'count': len(samples),
+            'wall': _describe([s[0] for s in samples]),
+            'cpu': _describe([s[1] for s in samples]),
+        }
+    return result
+
+
+def export_json(path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(summary(), f, indent=2)
+
+
+def print_summary():
+    content = summary()
+    print('{0:>24} {1:>7} {2:>10} {3:>10} {4:>10} {5:>10}'.format('stage', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'cpu p50'))
+    for name, stats in content.items():
+        wall, cpu = stats['wall'], stats['cpu']
+        print('{0:>24} {1:>7} {2:>10.2f} {3:>10.2f} {4:>10.2f} {5:>10.2f}'.format(
+            name, stats['count'], wall['p50'] * 1e3, wall['p95'] * 1e3, wall['p99'] * 1e3, cpu['p50'] * 1e3))
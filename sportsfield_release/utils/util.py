@@ -1,6 +1,7 @@
 '''utils functions, variables
 '''
 
+import contextlib
 import random
 
 #import readline
@@ -8,8 +9,9 @@ import numpy as np
 import torch
 try:
     import kornia
+    HAS_KORNIA = True
 except ModuleNotFoundError:
-    pass
+    HAS_KORNIA = False
 
 from sportsfield_release.utils import constant_var
 
@@ -53,9 +55,51 @@ def set_tensor_device(torch_var):
 
 def set_model_device(model):
     if constant_var.USE_CUDA:
-        return model.cuda()
-    else:
-        return model
+        model = model.cuda()
+    if constant_var.CHANNELS_LAST:
+        model = model.to(memory_format=torch.channels_last)
+    return model
+
+
+def apply_cpu_profile(threads=None, interop_threads=None, channels_last=None, bf16_autocast=None):
+    '''set the cpu execution profile, None leaves a setting as it is
+    it is global to the process: apply it before building the models
+    '''
+    if threads is not None:
+        constant_var.CPU_THREADS = threads
+        torch.set_num_threads(threads)
+    if interop_threads is not None:
+        constant_var.CPU_INTEROP_THREADS = interop_threads
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            # torch only accepts it before the first inter-op parallel work
+            print_notification(['Inter-op threads already fixed to {0}'.format(torch.get_num_interop_threads())], 'WARNING')
+    if channels_last is not None:
+        constant_var.CHANNELS_LAST = channels_last
+    if bf16_autocast is not None:
+        constant_var.BF16_AUTOCAST = bf16_autocast
+
+
+def get_cpu_profile():
+    return {'threads': torch.get_num_threads(), 'interop_threads': torch.get_num_interop_threads(),
+            'channels_last': constant_var.CHANNELS_LAST, 'bf16_autocast': constant_var.BF16_AUTOCAST}
+
+
+def set_memory_format(x):
+    '''4d tensors in channels_last when the profile asks for it
+    '''
+    if constant_var.CHANNELS_LAST and x.dim() == 4:
+        return x.contiguous(memory_format=torch.channels_last)
+    return x
+
+
+def autocast():
+    '''bfloat16 autocast on cpu when the profile asks for it, no-op otherwise
+    '''
+    if constant_var.BF16_AUTOCAST and not constant_var.USE_CUDA:
+        return torch.autocast('cpu', dtype=torch.bfloat16)
+    return contextlib.nullcontext()
 
 
 def to_numpy(cuda_var):
@@ -127,107 +171,149 @@ def LOWER_CANON4PTS_NP():
     return np.array([[-0.5, 0.1], [-0.5, 0.5], [0.5, 0.5], [0.5, 0.1]], dtype=np.float32)
 
 
-def get_perspective_transform(src, dst):
+def _get_perspective_transform_solve(src, dst):
+    r"""Calculates a perspective transform from four pairs of the corresponding
+    points.
+    The function calculates the matrix of a perspective transform so that:
+    .. math ::
+        \begin{bmatrix}
+        t_{i}x_{i}^{'} \\
+        t_{i}y_{i}^{'} \\
+        t_{i} \\
+        \end{bmatrix}
+        =
+        \textbf{map_matrix} \cdot
+        \begin{bmatrix}
+        x_{i} \\
+        y_{i} \\
+        1 \\
+        \end{bmatrix}
+    where
+    .. math ::
+        dst(i) = (x_{i}^{'},y_{i}^{'}), src(i) = (x_{i}, y_{i}), i = 0,1,2,3
+    Args:
+        src (Tensor): coordinates of quadrangle vertices in the source image.
+        dst (Tensor): coordinates of the corresponding quadrangle vertices in
+            the destination image.
+    Returns:
+        Tensor: the perspective transformation.
+    Shape:
+        - Input: :math:`(B, 4, 2)` and :math:`(B, 4, 2)`
+        - Output: :math:`(B, 3, 3)`
+    """
+    if not torch.is_tensor(src):
+        raise TypeError("Input type is not a torch.Tensor. Got {}"
+                        .format(type(src)))
+    if not torch.is_tensor(dst):
+        raise TypeError("Input type is not a torch.Tensor. Got {}"
+                        .format(type(dst)))
+    if not src.shape[-2:] == (4, 2):
+        raise ValueError("Inputs must be a Bx4x2 tensor. Got {}"
+                         .format(src.shape))
+    if not src.shape == dst.shape:
+        raise ValueError("Inputs must have the same shape. Got {}"
+                         .format(dst.shape))
+    if not (src.shape[0] == dst.shape[0]):
+        raise ValueError("Inputs must have same batch size dimension. Expect {} but got {}"
+                         .format(src.shape, dst.shape))
+
+    # rows of the 8x8 system for the 4 correspondences at once, (B, 4, 8) each
+    x, y = src[..., 0], src[..., 1]
+    u, v = dst[..., 0], dst[..., 1]
+    ones, zeros = torch.ones_like(x), torch.zeros_like(x)
+    ax = torch.stack([x, y, ones, zeros, zeros, zeros, -x * u, -y * u], dim=-1)
+    ay = torch.stack([zeros, zeros, zeros, x, y, ones, -x * v, -y * v], dim=-1)
+    # A is Bx8x8, rows interleaved as (ax_0, ay_0, ax_1, ...), b is Bx8x1
+    A = torch.stack([ax, ay], dim=2).reshape(-1, 8, 8)
+    b = dst.reshape(-1, 8, 1)
+
+    X = torch.linalg.solve(A, b)
+
+    # create variable to return
+    M = torch.cat([X[..., 0], torch.ones_like(X[:, :1, 0])], dim=1)
+    return M.view(-1, 3, 3)  # Bx3x3
+
+
+def _get_perspective_transform_kornia(src, dst):
     '''
     kornia: https://github.com/arraiyopensource/kornia
     license: https://github.com/arraiyopensource/kornia/blob/master/LICENSE
     '''
-    try:
-        return kornia.get_perspective_transform(src, dst)
-    except:
-        r"""Calculates a perspective transform from four pairs of the corresponding
-        points.
-        The function calculates the matrix of a perspective transform so that:
-        .. math ::
-            \begin{bmatrix}
-            t_{i}x_{i}^{'} \\
-            t_{i}y_{i}^{'} \\
-            t_{i} \\
-            \end{bmatrix}
-            =
-            \textbf{map_matrix} \cdot
-            \begin{bmatrix}
-            x_{i} \\
-            y_{i} \\
-            1 \\
-            \end{bmatrix}
-        where
-        .. math ::
-            dst(i) = (x_{i}^{'},y_{i}^{'}), src(i) = (x_{i}, y_{i}), i = 0,1,2,3
-        Args:
-            src (Tensor): coordinates of quadrangle vertices in the source image.
-            dst (Tensor): coordinates of the corresponding quadrangle vertices in
-                the destination image.
-        Returns:
-            Tensor: the perspective transformation.
-        Shape:
-            - Input: :math:`(B, 4, 2)` and :math:`(B, 4, 2)`
-            - Output: :math:`(B, 3, 3)`
-        """
-        if not torch.is_tensor(src):
-            raise TypeError("Input type is not a torch.Tensor. Got {}"
-                            .format(type(src)))
-        if not torch.is_tensor(dst):
-            raise TypeError("Input type is not a torch.Tensor. Got {}"
-                            .format(type(dst)))
-        if not src.shape[-2:] == (4, 2):
-            raise ValueError("Inputs must be a Bx4x2 tensor. Got {}"
-                            .format(src.shape))
-        if not src.shape == dst.shape:
-            raise ValueError("Inputs must have the same shape. Got {}"
-                            .format(dst.shape))
-        if not (src.shape[0] == dst.shape[0]):
-            raise ValueError("Inputs must have same batch size dimension. Expect {} but got {}"
-                            .format(src.shape, dst.shape))
-
-        def ax(p, q):
-            ones = torch.ones_like(p)[..., 0:1]
-            zeros = torch.zeros_like(p)[..., 0:1]
-            return torch.cat(
-                [p[:, 0:1], p[:, 1:2], ones, zeros, zeros, zeros,
-                -p[:, 0:1] * q[:, 0:1], -p[:, 1:2] * q[:, 0:1]
-                ], dim=1)
-
-        def ay(p, q):
-            ones = torch.ones_like(p)[..., 0:1]
-            zeros = torch.zeros_like(p)[..., 0:1]
-            return torch.cat(
-                [zeros, zeros, zeros, p[:, 0:1], p[:, 1:2], ones,
-                -p[:, 0:1] * q[:, 1:2], -p[:, 1:2] * q[:, 1:2]], dim=1)
-        # we build matrix A by using only 4 point correspondence. The linear
-        # system is solved with the least square method, so here
-        # we could even pass more correspondence
-        p = []
-        p.append(ax(src[:, 0], dst[:, 0]))
-        p.append(ay(src[:, 0], dst[:, 0]))
-
-        p.append(ax(src[:, 1], dst[:, 1]))
-        p.append(ay(src[:, 1], dst[:, 1]))
-
-        p.append(ax(src[:, 2], dst[:, 2]))
-        p.append(ay(src[:, 2], dst[:, 2]))
-
-        p.append(ax(src[:, 3], dst[:, 3]))
-        p.append(ay(src[:, 3], dst[:, 3]))
-
-        # A is Bx8x8
-        A = torch.stack(p, dim=1)
-
-        # b is a Bx8x1
-        b = torch.stack([
-            dst[:, 0:1, 0], dst[:, 0:1, 1],
-            dst[:, 1:2, 0], dst[:, 1:2, 1],
-            dst[:, 2:3, 0], dst[:, 2:3, 1],
-            dst[:, 3:4, 0], dst[:, 3:4, 1],
-        ], dim=1)
-
-        # solve the system Ax = b
-        #X, LU = torch.solve(b, A)
-        X = torch.linalg.solve(A, b) #modificato
-
-
-        # create variable to return
-        batch_size = src.shape[0]
-        M = torch.ones(batch_size, 9, device=src.device, dtype=src.dtype)
-        M[..., :8] = torch.squeeze(X, dim=-1)
-        return M.view(-1, 3, 3)  # Bx3x3
+    return kornia.get_perspective_transform(src, dst)
+
+
+# the backend is chosen once, when this module is imported
+get_perspective_transform = _get_perspective_transform_kornia if HAS_KORNIA else _get_perspective_transform_solve
+
+
+class RectToQuadTransform(object):
+    '''closed form homography from a fixed axis aligned rectangle to a batch of quads
+    the source points are constant (canon4pts): the rectangle to unit square affine map is
+    folded with Heckbert's unit square to quad formula into two constant matrices, so the
+    homography is two matmuls of polynomial features of the quads (differentiable w.r.t. them).
+    the rectangle must be in the order of FULL_CANON4PTS_NP:
+    (xmin, ymin), (xmin, ymax), (xmax, ymax), (xmax, ymin)
+    '''
+
+    def __init__(self, canon4pts):
+        canon4pts = np.asarray(canon4pts, dtype=np.float64)
+        (xmin, ymin), (_, ymax), (xmax, _) = canon4pts[0], canon4pts[1], canon4pts[2]
+        expected = np.array([[xmin, ymin], [xmin, ymax], [xmax, ymax], [xmax, ymin]])
+        assert np.allclose(canon4pts, expected) and xmax > xmin and ymax > ymin, \
+            'canon4pts should be an axis aligned rectangle'
+        rect_to_square = np.array([[1.0 / (xmax - xmin), 0.0, -xmin / (xmax - xmin)],
+                                   [0.0, 1.0 / (ymax - ymin), -ymin / (ymax - ymin)],
+                                   [0.0, 0.0, 1.0]])
+
+        # the quad is flattened as v = (x0, y0, ..., x3, y3); square corners (0, 0), (1, 0), (1, 1), (0, 1)
+        # go to the quad points 0, 3, 2, 1 (q0..q3 below), like the rectangle corners
+        order = (0, 3, 2, 1)
+
+        def q(k):
+            selector = np.zeros((2, 8))
+            selector[0, 2 * order[k]] = selector[1, 2 * order[k] + 1] = 1
+            return selector
+
+        def cross(a, b):
+            # a x b = v^T W v, for a and b linear in v
+            return np.outer(a[0], b[1]) - np.outer(a[1], b[0])
+        d1, d2 = q(1) - q(2), q(3) - q(2)
+        s = q(0) - q(1) + q(2) - q(3)
+        # Heckbert: g = (s x d2) / den, h = (d1 x s) / den, den = d1 x d2
+        cross_form = np.stack([cross(s, d2), cross(d1, s), cross(d1, d2)], axis=-1).reshape(64, 3)
+
+        # square to quad matrix scaled by den, linear in the features
+        # f = (g, h, den, v_0 g, v_0 h, v_0 den, ..., v_7 den) (g and h scaled by den too):
+        # [[q1x (den + g) - q0x den, q3x (den + h) - q0x den, q0x den],
+        #  [q1y (den + g) - q0y den, q3y (den + h) - q0y den, q0y den],
+        #  [g, h, den]]
+        G, H, DEN = 0, 1, 2
+        linear = np.zeros((27, 3, 3))
+        linear[G, 2, 0] = linear[H, 2, 1] = linear[DEN, 2, 2] = 1
+        for axis in (0, 1):
+            q0, q1, q3 = (2 * order[k] + axis for k in (0, 1, 3))
+            for v_index, factor, col, coef in [(q1, DEN, 0, 1), (q1, G, 0, 1), (q0, DEN, 0, -1),
+                                               (q3, DEN, 1, 1), (q3, H, 1, 1), (q0, DEN, 1, -1),
+                                               (q0, DEN, 2, 1)]:
+                linear[3 + 3 * v_index + factor, axis, col] += coef
+        features_to_homography = np.matmul(linear, rect_to_square).reshape(27, 9)
+        self.constants = (cross_form, features_to_homography)
+        self._cache = {}
+
+    def _get_constants(self, device, dtype):
+        key = (torch.device(device), dtype)
+        if key not in self._cache:
+            self._cache[key] = tuple(torch.tensor(c, device=device, dtype=dtype) for c in self.constants)
+        return self._cache[key]
+
+    def __call__(self, dst):
+        '''dst: (B, 4, 2) quads, corresponding to the rectangle corners
+        return: (B, 3, 3) homographies, normalized so that H[2, 2] = 1
+        '''
+        cross_form, features_to_homography = self._get_constants(dst.device, dst.dtype)
+        batch_size = dst.shape[0]
+        v = dst.reshape(batch_size, 8)
+        gh_den = torch.matmul((v[:, :, None] * v[:, None, :]).reshape(batch_size, 64), cross_form)
+        features = torch.cat([gh_den, (v[:, :, None] * gh_den[:, None, :]).reshape(batch_size, 24)], dim=1)
+        homography = torch.matmul(features, features_to_homography).view(batch_size, 3, 3)
+        return homography / homography[:, 2:3, 2:3]
@@ -5,6 +5,33 @@ import numpy as np
 from sportsfield_release.utils import util
 
 
+# homogeneous sampling grids, keyed by (height, width, device, dtype)
+_GRID_CACHE = {}
+
+
+def get_homogeneous_grid(out_shape, device, dtype=torch.float32):
+    '''
+    homogeneous coordinates of the output pixels, in frame coordinates
+    the grid only depends on the output shape, so it is built once and cached
+
+    Return:
+        xy -- torch.Size([3, H * W])
+    '''
+    key = (int(out_shape[-2]), int(out_shape[-1]), torch.device(device), dtype)
+    xy = _GRID_CACHE.get(key)
+    if xy is None:
+        y, x = torch.meshgrid([
+            torch.linspace(-util.BASE_RANGE, util.BASE_RANGE,
+                           steps=out_shape[-2], device=device, dtype=dtype),
+            torch.linspace(-util.BASE_RANGE, util.BASE_RANGE,
+                           steps=out_shape[-1], device=device, dtype=dtype)
+        ], indexing='ij')
+        x, y = x.flatten(), y.flatten()
+        xy = torch.stack([x, y, torch.ones_like(x)])
+        _GRID_CACHE[key] = xy
+    return xy
+
+
 def warp_image(img, H, out_shape=None, input_grid=None):
     if out_shape is None:
         out_shape = img.shape[-2:]
@@ -14,45 +41,30 @@ def warp_image(img, H, out_shape=None, input_grid=None):
         H = H[None]
     assert img.shape[0] == H.shape[0], 'batch size of images do not match the batch size of homographies'
     batchsize = img.shape[0]
-    # create grid for interpolation (in frame coordinates)
+    # grid for interpolation (in frame coordinates)
+    dtype = img.dtype if img.is_floating_point() else torch.float32
     if input_grid is None:
-        y, x = torch.meshgrid([
-            torch.linspace(-util.BASE_RANGE, util.BASE_RANGE,
-                           steps=out_shape[-2]),
-            torch.linspace(-util.BASE_RANGE, util.BASE_RANGE,
-                           steps=out_shape[-1])
-        ])
-        x = x.to(img.device)
-        y = y.to(img.device)
+        xy = get_homogeneous_grid(out_shape, img.device, dtype)
     else:
         x, y = input_grid
-    x, y = x.flatten(), y.flatten()
+        x, y = x.flatten(), y.flatten()
+        xy = torch.stack([x, y, torch.ones_like(x)])
 
-    # append ones for homogeneous coordinates
-    xy = torch.stack([x, y, torch.ones_like(x)])
-    xy = xy.repeat([batchsize, 1, 1])  # shape: (B, 3, N)
-    # warp points to model coordinates
-    xy_warped = torch.matmul(H, xy)  # H.bmm(xy)
+    # warp points to model coordinates, (B, 3, 3) x (3, N) broadcasts to (B, 3, N)
+    xy_warped = torch.matmul(H.to(dtype), xy)
     xy_warped, z_warped = xy_warped.split(2, dim=1)
 
     # we multiply by 2, since our homographies map to
     # coordinates in the range [-0.5, 0.5] (the ones in our GT datasets)
     xy_warped = 2.0 * xy_warped / (z_warped + 1e-8)
-    x_warped, y_warped = torch.unbind(xy_warped, dim=1)
-    # build grid
-    grid = torch.stack([
-        x_warped.view(batchsize, *out_shape[-2:]),
-        y_warped.view(batchsize, *out_shape[-2:])
-    ],
-        dim=-1)
-
-    # sample warped image
-    warped_img = torch.nn.functional.grid_sample(
-        img, grid, mode='bilinear', padding_mode='zeros')
+    # build grid, (B, 2, N) -> (B, H, W, 2)
+    grid = xy_warped.transpose(1, 2).reshape(batchsize, *out_shape[-2:], 2)
+    # invalid coordinates are sent outside the image, where the zero padding samples 0
+    grid = torch.nan_to_num(grid, nan=-2.0, posinf=2.0, neginf=-2.0)
 
-    if util.hasnan(warped_img):
-        print('nan value in warped image! set to zeros')
-        warped_img[util.isnan(warped_img)] = 0
+    # sample warped image, the grid stays in float32 whatever the profile
+    warped_img = torch.nn.functional.grid_sample(
+        util.set_memory_format(img), grid, mode='bilinear', padding_mode='zeros')
 
     return warped_img
 
@@ -1,5 +1,8 @@
 import cv2
 
+from sportsfield_release.utils import profiling
+
+@profiling.timed('render_boxes')
 def draw_boxes(image, boxes, classes, players_classification=None):
     """
     Disegna bounding box su immagine con colori e etichette per squadre, portiere, arbitro e pallone.